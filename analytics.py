@@ -0,0 +1,113 @@
+import time
+from collections import deque
+
+# Скользящие окна для темпа роста: название -> длина в секундах
+WINDOWS = {'1ч': 3600, '24ч': 86400, '7д': 7 * 86400}
+
+# Порядок окон, по которым строится прогноз: самое надежное - сутки
+FORECAST_WINDOWS = ('24ч', '7д', '1ч')
+
+
+class _Window:
+    """Приращения за последние size секунд с текущими суммами"""
+
+    def __init__(self, size):
+        self.size = size
+        self.events = deque()
+        self.contracts = 0
+        self.paid = 0
+
+    def add(self, ts, contracts, paid):
+        self.events.append((ts, contracts, paid))
+        self.contracts += contracts
+        self.paid += paid
+
+    def evict(self, now):
+        """Убрать приращения, вышедшие за окно (каждое убирается один раз)"""
+        events = self.events
+        while events and events[0][0] <= now - self.size:
+            _, contracts, paid = events.popleft()
+            self.contracts -= contracts
+            self.paid -= paid
+
+
+class ProgramVelocity:
+    """Темп роста договоров одной программы по скользящим окнам"""
+
+    def __init__(self):
+        self.windows = {name: _Window(size) for name, size in WINDOWS.items()}
+        self.first_ts = None
+        # Последнее значение: (ts, договоров, оплачено)
+        self.last = None
+
+    def add(self, ts, contracts, paid):
+        """Учесть новый снимок: в окна попадает только приращение к предыдущему"""
+        # В записях старого CSV нет числа оплаченных: по ним темп не считается
+        if contracts is None or paid is None:
+            return
+        if self.last is None:
+            self.first_ts = ts
+        else:
+            _, last_contracts, last_paid = self.last
+            if contracts != last_contracts or paid != last_paid:
+                for window in self.windows.values():
+                    window.add(ts, contracts - last_contracts, paid - last_paid)
+        self.last = (ts, contracts, paid)
+
+    def rates(self, now=None):
+        """По окнам: (прирост договоров, прирост оплаченных, договоров в час, оплаченных в час)"""
+        now = now or time.time()
+        result = {}
+        for name, window in self.windows.items():
+            window.evict(now)
+            # Пока история короче окна, темп считается по фактически наблюдаемому времени
+            hours = min(window.size, now - self.first_ts) / 3600 if self.first_ts is not None else 0
+            result[name] = (
+                window.contracts,
+                window.paid,
+                window.contracts / hours if hours > 0 else 0.0,
+                window.paid / hours if hours > 0 else 0.0
+            )
+        return result
+
+    def forecast(self, target, paid=False, now=None):
+        """Через сколько секунд будет достигнуто target договоров (или оплаченных).
+
+        Возвращает (секунды, окно, темп в час): 0 - уже достигнуто, None - темп не положительный.
+        """
+        if self.last is None:
+            return None, None, 0.0
+
+        current = self.last[2] if paid else self.last[1]
+        if current >= target:
+            return 0, None, 0.0
+
+        rates = self.rates(now)
+        for name in FORECAST_WINDOWS:
+            rate = rates[name][3 if paid else 2]
+            if rate > 0:
+                return (target - current) / rate * 3600, name, rate
+        return None, None, 0.0
+
+
+class VelocityTracker:
+    """Темпы роста по всем программам, обновляются при сохранении каждого снимка"""
+
+    def __init__(self):
+        self.programs = {}
+
+    def get(self, program):
+        if program not in self.programs:
+            self.programs[program] = ProgramVelocity()
+        return self.programs[program]
+
+    def add(self, program, ts, contracts, paid):
+        self.get(program).add(ts, contracts, paid)
+
+    async def rebuild(self, programs, load_series):
+        """Восстановить окна после перезапуска: load_series(program, since) -> [(ts, договоров, оплачено)]"""
+        since = int(time.time()) - max(WINDOWS.values())
+        for program in programs:
+            velocity = self.programs[program] = ProgramVelocity()
+            for ts, contracts, paid in await load_series(program, since):
+                velocity.add(ts, contracts, paid)
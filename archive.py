@@ -0,0 +1,275 @@
+"""Архив загруженных страниц рейтинга и повторный разбор истории из него.
+
+Каждая новая версия страницы сохраняется в ARCHIVE_DIR сжатой gzip под своим
+SHA-256 (ab/abcdef....html.gz), поэтому одинаковые страницы хранятся один раз.
+Когда и для какой программы страница была загружена, записывается в index.csv.
+Архив не зависит от базы: по нему можно заново построить историю, например
+после исправления ошибки разбора.
+
+Запуск из командной строки:
+    python archive.py stats
+    python archive.py replay data/rebuilt.db [--program ...] [--workers 4]
+    python archive.py replay --backfill --since 2025-08-01 [--until 2025-08-03]
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from config import ARCHIVE_DIR, DEFAULT_PROGRAM, PARSER_BACKEND
+
+INDEX_FILE = 'index.csv'
+INDEX_HEADER = ('ts', 'program', 'sha256', 'size')
+
+# Сколько страниц отдается процессу разбора за раз
+REPLAY_CHUNK_SIZE = 4
+
+# Насколько запись в истории может отставать от загрузки страницы в архив (секунды)
+BACKFILL_TOLERANCE = 60
+
+
+def page_path(directory, digest):
+    """Путь к сжатой странице по ее SHA-256"""
+    return os.path.join(directory, digest[:2], f'{digest}.html.gz')
+
+
+def store_page(directory, program, ts, content):
+    """Сохранить страницу (если ее еще нет) и добавить загрузку в индекс, вернуть SHA-256"""
+    digest = hashlib.sha256(content).hexdigest()
+    path = page_path(directory, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Запись через временный файл: в архиве не бывает недописанных страниц
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with gzip.open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    index_path = os.path.join(directory, INDEX_FILE)
+    is_new = not os.path.exists(index_path)
+    with open(index_path, 'a', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        if is_new:
+            writer.writerow(INDEX_HEADER)
+        writer.writerow((ts, program or '', digest, len(content)))
+    return digest
+
+
+async def archive_page(program, content, directory=ARCHIVE_DIR):
+    """Сохранить загруженную страницу в архив в фоновом потоке.
+
+    Ошибка записи только выводится: архив не должен мешать парсингу.
+    """
+    if not directory:
+        return None
+    try:
+        return await asyncio.to_thread(store_page, directory, program, int(time.time()), content)
+    except OSError as e:
+        print(f"❌ Ошибка записи страницы в архив: {e}")
+        return None
+
+
+def read_index(directory=ARCHIVE_DIR, program=None, since=None, until=None):
+    """Загрузки из индекса архива по времени: [(ts, program, sha256, size)]"""
+    entries = []
+    try:
+        with open(os.path.join(directory, INDEX_FILE), encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                ts = int(row['ts'])
+                if program is not None and row['program'] != program:
+                    continue
+                if (since is not None and ts < since) or (until is not None and ts >= until):
+                    continue
+                entries.append((ts, row['program'], row['sha256'], int(row['size'])))
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+def _parse_page(args):
+    """Разобрать страницу из архива в процессе пула: (sha256, строки рейтинга, отпечаток)"""
+    path, backend = args
+    from extractors import get_extractor
+    from snapshot import fingerprint_rows
+
+    with gzip.open(path, 'rb') as file:
+        items = get_extractor(backend)(file.read())
+    return os.path.basename(path).split('.')[0], tuple(items), fingerprint_rows(items)
+
+
+def parse_pages(directory, digests, backend=PARSER_BACKEND, workers=None):
+    """Разобрать различные страницы архива пулом процессов: {sha256: (строки, отпечаток)}"""
+    tasks = [(page_path(directory, digest), backend) for digest in sorted(digests)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return {digest: (items, fingerprint)
+                for digest, items, fingerprint in executor.map(_parse_page, tasks, chunksize=REPLAY_CHUNK_SIZE)}
+
+
+async def rebuild_history(entries, parsed):
+    """Сохранить загрузки из архива по порядку как обычные снимки, вернуть число сохраненных.
+
+    База должна быть новой: снимки задним числом нельзя вставить в середину
+    существующей истории позиций.
+    """
+    from database import MOSCOW_TZ, save_rating_data
+    from snapshot import RatingSnapshot
+
+    for ts, program, digest, _ in entries:
+        moment = datetime.fromtimestamp(ts, MOSCOW_TZ)
+        items, fingerprint = parsed[digest]
+        snapshot = RatingSnapshot.from_items(items, moment.strftime('%Y-%m-%d %H:%M:%S'),
+                                             program or None, fingerprint)
+        await save_rating_data(snapshot, moment)
+    return len(entries)
+
+
+async def backfill_history(entries, parsed):
+    """Добавить в rating_history итоги загрузок, которых там нет, вернуть (добавлено, пропущено).
+
+    Загрузки и записи истории просматриваются по времени: загрузка пропускается,
+    если рейтинг не изменился с предыдущей записи или эта загрузка уже есть в
+    истории. Позиции абитуриентов не добавляются, поэтому загрузки новее последней
+    записи программы тоже пропускаются: иначе последним снимком стала бы запись без позиций.
+    """
+    from database import MOSCOW_TZ, connection
+    from history_io import insert_rating_rows
+    from snapshot import RatingSnapshot
+
+    async with connection() as db:
+        cursor = await db.execute('SELECT program, MAX(ts) FROM rating_history GROUP BY program')
+        latest = dict(await cursor.fetchall())
+
+        cursor = await db.execute('''
+            SELECT ts, program, fingerprint FROM rating_history
+            WHERE ts BETWEEN ? AND ? AND fingerprint IS NOT NULL
+        ''', (entries[0][0], entries[-1][0] + BACKFILL_TOLERANCE))
+        stored = await cursor.fetchall()
+
+    recorded = {}
+    for ts, program, fingerprint in stored:
+        recorded.setdefault((program, fingerprint), []).append(ts)
+
+    # Записи истории идут раньше загрузок в ту же секунду
+    events = sorted([(ts, 0, program, fingerprint) for ts, program, fingerprint in stored]
+                    + [(ts, 1, program or DEFAULT_PROGRAM, digest) for ts, program, digest, _ in entries])
+    rows = []
+    previous = {}
+    newer = 0
+    for ts, from_archive, program, value in events:
+        if not from_archive:
+            previous[program] = value
+            continue
+        if program in latest and ts > latest[program]:
+            newer += 1
+            continue
+
+        items, fingerprint = parsed[value]
+        # Страница пишется в архив до разбора, запись в истории появляется чуть позже
+        if previous.get(program) == fingerprint or any(
+                0 <= stored_ts - ts <= BACKFILL_TOLERANCE for stored_ts in recorded.get((program, fingerprint), ())):
+            continue
+        previous[program] = fingerprint
+        moment = datetime.fromtimestamp(ts, MOSCOW_TZ)
+        snapshot = RatingSnapshot.from_items(items, '', program, fingerprint)
+        rows.append((program, moment.strftime('%Y-%m-%d %H:%M:%S'), ts, snapshot.total_people, snapshot.contract_count,
+                     snapshot.contract_paid_count, snapshot.contract_unpaid_count))
+
+    if newer:
+        print(f"⚠️ Загрузок новее последней записи истории: {newer}, пропущены "
+              f"(полную историю строит replay в новую базу)")
+    inserted = await insert_rating_rows(rows)
+    return inserted, len(entries) - inserted
+
+
+def _parse_date(value):
+    """Дата ГГГГ-ММ-ДД (московское время) в секунды эпохи"""
+    from database import MOSCOW_TZ
+    return int(MOSCOW_TZ.localize(datetime.strptime(value, '%Y-%m-%d')).timestamp())
+
+
+def _print_stats(directory):
+    entries = read_index(directory)
+    digests = {entry[2] for entry in entries}
+    raw_size = sum(entry[3] for entry in {entry[2]: entry for entry in entries}.values())
+    stored_size = sum(os.path.getsize(page_path(directory, digest)) for digest in digests
+                      if os.path.exists(page_path(directory, digest)))
+    print(f"📦 Архив {directory}: загрузок {len(entries)}, различных страниц {len(digests)}")
+    if raw_size:
+        print(f"💾 Размер страниц {raw_size / 1024 / 1024:.1f} МБ, на диске {stored_size / 1024 / 1024:.1f} МБ "
+              f"({stored_size / raw_size:.0%})")
+
+
+async def _replay(args):
+    import database
+
+    since = _parse_date(args.since) if args.since else None
+    until = _parse_date(args.until) if args.until else None
+    entries = read_index(args.archive, args.program, since, until)
+    if not entries:
+        print("⚠️ В архиве нет подходящих загрузок")
+        return
+
+    started = time.perf_counter()
+    parsed = parse_pages(args.archive, {entry[2] for entry in entries}, args.backend, args.workers)
+    print(f"🔍 Разобрано страниц: {len(parsed)} за {time.perf_counter() - started:.1f} с")
+
+    if not args.backfill:
+        # История строится в отдельной базе, рабочая база не затрагивается
+        database.DB_FILE = args.output
+
+    await database.init_database()
+    try:
+        if args.backfill:
+            print(f"⚠️ Итоги из архива дописываются в рабочую базу {database.DB_FILE}")
+            inserted, skipped = await backfill_history(entries, parsed)
+            print(f"✅ Добавлено записей: {inserted}, пропущено: {skipped}")
+        else:
+            saved = await rebuild_history(entries, parsed)
+            print(f"✅ Снимков сохранено в {args.output}: {saved}")
+    finally:
+        await database.close_database()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Архив загруженных страниц рейтинга")
+    parser.add_argument('--archive', default=ARCHIVE_DIR, help="Папка архива")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('stats', help="Размер архива")
+
+    replay_parser = subparsers.add_parser('replay', help="Заново разобрать архив в историю")
+    replay_parser.add_argument('output', nargs='?', help="Новая база для полной истории")
+    replay_parser.add_argument('--backfill', action='store_true',
+                               help="Дописать недостающие итоги в рабочую базу вместо новой")
+    replay_parser.add_argument('--program', default=None, help="Только одна программа")
+    replay_parser.add_argument('--since', default=None, help="С даты ГГГГ-ММ-ДД")
+    replay_parser.add_argument('--until', default=None, help="До даты ГГГГ-ММ-ДД (не включая)")
+    replay_parser.add_argument('--backend', default=PARSER_BACKEND, help="Бэкенд разбора")
+    replay_parser.add_argument('--workers', type=int, default=None, help="Число процессов разбора")
+
+    args = parser.parse_args()
+    if not args.archive:
+        parser.error("ARCHIVE_DIR не задан")
+    if args.command == 'stats':
+        _print_stats(args.archive)
+        return
+
+    if args.backfill:
+        # Без периода дописывались бы и записи, удаленные очисткой истории
+        if not args.since:
+            parser.error("для --backfill нужен --since")
+    elif not args.output:
+        parser.error("укажите новую базу или --backfill")
+    elif os.path.exists(args.output):
+        parser.error(f"{args.output} уже существует: история строится только в новой базе")
+    asyncio.run(_replay(args))
+
+
+if __name__ == '__main__':
+    main()
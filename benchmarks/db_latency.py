@@ -0,0 +1,80 @@
+"""Задержка одного обращения к базе: соединение на каждый вызов против пула.
+
+Запуск из корня репозитория:
+    python benchmarks/db_latency.py [--calls 2000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+# База создается во временной директории (удаляется после запуска), токен нужен только для импорта config
+BENCH_DIR = tempfile.mkdtemp(prefix='itmo_bench_')
+os.environ['DB_FILE'] = os.path.join(BENCH_DIR, 'database.db')
+os.environ.setdefault('BOT_TOKEN', '1:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite  # noqa: E402
+
+import database  # noqa: E402
+from config import DB_FILE  # noqa: E402
+
+
+async def get_user_id_per_call(user_id):
+    """Чтение как до появления пула: новое соединение на каждый вызов"""
+    async with aiosqlite.connect(DB_FILE) as db:
+        cursor = await db.execute('SELECT your_id FROM users WHERE user_id = ?', (user_id,))
+        result = await cursor.fetchone()
+        return result[0] if result and result[0] else None
+
+
+async def set_user_id_per_call(user_id, your_id):
+    """Запись как до появления пула: новое соединение и commit на каждый вызов"""
+    async with aiosqlite.connect(DB_FILE) as db:
+        await db.execute('UPDATE users SET your_id = ? WHERE user_id = ?', (your_id, user_id))
+        await db.commit()
+
+
+async def measure(name, call, calls):
+    """Выполнить call(i) calls раз и вывести задержки в миллисекундах"""
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        await call(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:<28} mean {mean:7.3f} мс  p50 {p50:7.3f} мс  p99 {p99:7.3f} мс")
+    return mean
+
+
+async def main(calls):
+    await database.init_database()
+    users = 100
+    for user_id in range(users):
+        database.record_activity(user_id, f'user{user_id}')
+    await database.flush_activity()
+
+    print(f"📁 {DB_FILE}, вызовов: {calls}")
+    before_read = await measure('get_user_id: per-call', lambda i: get_user_id_per_call(i % users), calls)
+    after_read = await measure('get_user_id: pool', lambda i: database.get_user_id(i % users), calls)
+    before_write = await measure('set_user_id: per-call', lambda i: set_user_id_per_call(i % users, str(i)), calls)
+    after_write = await measure('set_user_id: pool', lambda i: database.set_user_id(i % users, str(i)), calls)
+
+    print(f"Ускорение чтения: x{before_read / after_read:.1f}, записи: x{before_write / after_write:.1f}")
+    await database.close_database()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    try:
+        asyncio.run(main(parser.parse_args().calls))
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
@@ -0,0 +1,300 @@
+"""Офлайн-бенчмарки горячих путей: разбор страницы, база данных, рассылка и запуск.
+
+Сеть не нужна: страницы рейтинга генерируются с разметкой RatingPage_table__item__qMY0F,
+база создается во временной директории, сообщения уходят в поддельный Bot.
+
+Запуск из корня репозитория:
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# База создается во временной директории (удаляется после запуска), токен нужен только для импорта config
+BENCH_DIR = tempfile.mkdtemp(prefix='itmo_bench_')
+os.environ['DB_FILE'] = os.path.join(BENCH_DIR, 'database.db')
+os.environ.setdefault('BOT_TOKEN', '1:benchmark')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database  # noqa: E402
+from broadcast import Broadcaster  # noqa: E402
+from extractors import (EXTRACTORS, ITEM_CLASS, POSITION_CLASS, PAID_CLASS, UNPAID_CLASS,  # noqa: E402
+                        lxml_available)
+from outbox import OutboxWorker  # noqa: E402
+from snapshot import RatingSnapshot  # noqa: E402
+
+PROGRAM = 'bench/contract/1'
+
+# Метрики, у которых больше - лучше (у остальных лучше меньше)
+HIGHER_IS_BETTER = ('rows_per_s', 'msgs_per_s')
+
+
+def synthetic_page(rows, seed=1, contract_share=0.3):
+    """Страница рейтинга из rows строк с разметкой как на abit.itmo.ru"""
+    rnd = random.Random(seed)
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>Рейтинг</title>'
+             '<script>window.__DATA__ = {"Договор: да": 1}</script></head><body><main>']
+    for i in range(rows):
+        has_contract = rnd.random() < contract_share
+        color = ''
+        if has_contract:
+            color = rnd.choice([' ' + PAID_CLASS, ' ' + UNPAID_CLASS, ''])
+        parts.append(
+            f'<div class="{ITEM_CLASS}{color}">'
+            f'<div class="RatingPage_table__info__Ab1cD">'
+            f'<p class="{POSITION_CLASS}">{i + 1} <span>{4000000 + rnd.randrange(10 ** 6)}</span></p>'
+            f'<p>Приоритет: {rnd.randint(1, 5)}</p><p>Сумма баллов: {rnd.randint(150, 310)}</p>'
+            f'<p>Договор: {"да" if has_contract else "нет"}</p>'
+            f'</div></div>'
+        )
+    parts.append('</main></body></html>')
+    return '\n'.join(parts).encode()
+
+
+def summarize(latencies):
+    """Среднее, медиана и 99-й перцентиль задержек в миллисекундах"""
+    latencies = sorted(latencies)
+    return {
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p99_ms': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    }
+
+
+def bench_parse(sizes, backends, repeat):
+    """Скорость разбора (извлечение строк и построение снимка) и пиковая память"""
+    results = {}
+    for rows in sizes:
+        page = synthetic_page(rows)
+        for name in backends:
+            extract = EXTRACTORS[name]
+
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                RatingSnapshot.from_items(extract(page), 't', PROGRAM)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            tracemalloc.start()
+            RatingSnapshot.from_items(extract(page), 't', PROGRAM)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            prefix = f'parse.{name}.{rows}'
+            results[f'{prefix}.seconds'] = best
+            results[f'{prefix}.rows_per_s'] = rows / best
+            results[f'{prefix}.peak_mb'] = peak / 2 ** 20
+            print(f"{name:<10} {rows:>6} строк: {best * 1000:9.1f} мс, {rows / best:10.0f} строк/с, "
+                  f"пик памяти {peak / 2 ** 20:7.1f} МБ")
+    return results
+
+
+async def measure(name, call, calls):
+    """Выполнить call(i) calls раз, вывести и вернуть задержки"""
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        await call(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    stats = summarize(latencies)
+    print(f"{name:<28} mean {stats['mean_ms']:7.3f} мс  p50 {stats['p50_ms']:7.3f} мс  "
+          f"p99 {stats['p99_ms']:7.3f} мс")
+    return {f'db.{name}.{key}': value for key, value in stats.items()}
+
+
+def random_snapshot(rnd, ids, rows):
+    """Снимок из rows случайных абитуриентов"""
+    items = [(application_id, rnd.random() < 0.3, rnd.random() < 0.5, False)
+             for application_id in rnd.sample(ids, rows)]
+    return RatingSnapshot.from_items(items, 't', PROGRAM)
+
+
+async def bench_db(calls, users, rows):
+    """Задержка запросов к временной базе с заполненными пользователями и историей"""
+    await database.init_database()
+    for user_id in range(users):
+        database.record_activity(user_id, f'user{user_id}')
+    await database.flush_activity()
+    for user_id in range(users):
+        await database.subscribe_user(user_id)
+        await database.set_user_id(user_id, str(4000000 + user_id))
+
+    rnd = random.Random(1)
+    ids = [str(4000000 + i) for i in range(rows * 2)]
+    save_calls = min(calls, 100)
+    snapshots = [random_snapshot(rnd, ids, rows) for _ in range(5 + save_calls)]
+    for snapshot in snapshots[:5]:
+        await database.save_rating_data(snapshot)
+
+    results = {}
+    results.update(await measure('get_user_id', lambda i: database.get_user_id(i % users), calls))
+    results.update(await measure('set_user_id', lambda i: database.set_user_id(i % users, str(i)), calls))
+    results.update(await measure('get_user_programs', lambda i: database.get_user_programs(i % users), calls))
+    results.update(await measure('get_program_subscribers',
+                                 lambda i: database.get_program_subscribers(PROGRAM), min(calls, 200)))
+    results.update(await measure('get_applicant_timeline',
+                                 lambda i: database.get_applicant_timeline(PROGRAM, ids[i % len(ids)]), calls))
+    results.update(await measure('get_rating_stats', lambda i: database.get_rating_stats(), calls))
+    results.update(await measure('get_rating_rollup', lambda i: database.get_rating_rollup(PROGRAM), calls))
+    results.update(await measure('load_last_snapshot',
+                                 lambda i: database.load_last_snapshot(PROGRAM), min(calls, 50)))
+
+    # Новый снимок пишет дельту позиций, повторный - только отметку last_seen
+    results.update(await measure('save_rating_data.changed',
+                                 lambda i: database.save_rating_data(snapshots[5 + i]), save_calls))
+    results.update(await measure('save_rating_data.heartbeat',
+                                 lambda i: database.save_rating_data(snapshots[4 + save_calls]), calls))
+    await database.close_database()
+    return results
+
+
+class FakeBot:
+    """Bot, который отвечает с задержкой сети и ничего не отправляет"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+async def bench_broadcast(subscribers, rate, latency):
+    """Время рассылки через очередь outbox поддельному Bot"""
+    await database.init_database()
+    bot = FakeBot(latency)
+    worker = OutboxWorker(Broadcaster(bot, rate=rate))
+    start = time.perf_counter()
+    await database.enqueue_messages('bench', [(user_id, 'Текст', None) for user_id in range(subscribers)])
+    while await worker.deliver_batch():
+        pass
+    elapsed = time.perf_counter() - start
+    await database.close_database()
+
+    print(f"outbox:    {bot.sent} сообщений за {elapsed:6.2f} с ({bot.sent / elapsed:7.1f} сообщ/с)")
+    return {'broadcast.outbox.seconds': elapsed, 'broadcast.outbox.msgs_per_s': bot.sent / elapsed}
+
+
+def bench_startup(repeat):
+    """Время импорта main.py в отдельном процессе: основная часть запуска до начала polling"""
+    from config import STARTUP_BUDGET
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=ROOT, env=os.environ.copy(), check=True,
+                       stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    mark = '✅' if best <= STARTUP_BUDGET else '❌'
+    print(f"{mark} import main: {best:.3f} с (бюджет запуска {STARTUP_BUDGET:.1f} с)")
+    return {'startup.import_main.seconds': best}
+
+
+async def bench_async(args, skip):
+    """Разделы, которым нужен event loop, выполняются в одном цикле"""
+    results = {}
+    if 'db' not in skip:
+        print(f"\n📁 База данных ({database.DB_FILE}):")
+        results.update(await bench_db(args.calls, args.users, args.rows))
+    if 'broadcast' not in skip:
+        print(f"\n📢 Рассылка (лимит {args.rate:.0f} сообщ/с, задержка Bot {args.latency * 1000:.0f} мс):")
+        results.update(await bench_broadcast(args.subscribers, args.rate, args.latency))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Сравнить результаты с сохраненными ранее"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+
+    print(f"\n📊 Сравнение с {baseline_path}:")
+    for key, value in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        change = (value - before) / before * 100
+        better = (change > 0) == key.endswith(HIGHER_IS_BETTER)
+        mark = '✅' if abs(change) < 5 or better else '❌'
+        print(f"{mark} {key:<48} {before:12.3f} → {value:12.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,50000', help='число строк на страницах через запятую')
+    parser.add_argument('--backends', default=None, help='бэкенды разбора через запятую (по умолчанию все)')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов разбора (берется лучший)')
+    parser.add_argument('--calls', type=int, default=500, help='вызовов каждого запроса к базе')
+    parser.add_argument('--users', type=int, default=1000, help='пользователей во временной базе')
+    parser.add_argument('--rows', type=int, default=5000, help='строк в сохраняемых снимках')
+    parser.add_argument('--subscribers', type=int, default=2000, help='получателей рассылки')
+    parser.add_argument('--rate', type=float, default=1000, help='лимит рассылки, сообщений в секунду')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа поддельного Bot, сек')
+    parser.add_argument('--skip', default='', help='пропустить разделы: parse, db, broadcast, startup')
+    parser.add_argument('--output', default=None, help='сохранить результаты в JSON')
+    parser.add_argument('--compare', default=None, help='сравнить с результатами из JSON')
+    args = parser.parse_args()
+
+    skip = set(filter(None, args.skip.split(',')))
+    if args.backends:
+        backends = args.backends.split(',')
+    else:
+        backends = [name for name in EXTRACTORS if name != 'lxml' or lxml_available()]
+
+    results = {}
+    if 'parse' not in skip:
+        print("🧩 Разбор страницы:")
+        results.update(bench_parse([int(size) for size in args.sizes.split(',')], backends, args.repeat))
+    results.update(asyncio.run(bench_async(args, skip)))
+    if 'startup' not in skip:
+        print("\n⚡ Запуск:")
+        results.update(bench_startup(args.repeat))
+
+    if args.output:
+        report = {
+            'meta': {
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'args': vars(args)
+            },
+            'results': results
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
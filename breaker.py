@@ -0,0 +1,99 @@
+import time
+
+from config import BREAKER_FAILURES, BREAKER_RESET, BREAKER_MAX_RESET
+from metrics import BREAKER_STATE, BREAKER_TRANSITIONS
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+# Значения метрики состояния
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнялся: предохранитель разомкнут"""
+
+
+class CircuitBreaker:
+    """Предохранитель для запросов к одному сайту.
+
+    После failures неудачных запросов подряд размыкается: запросы не выполняются
+    reset_timeout секунд. Затем пропускается одна проба: удача замыкает
+    предохранитель, неудача снова размыкает его с вдвое большей паузой
+    (не больше max_reset_timeout).
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET,
+                 max_reset_timeout=BREAKER_MAX_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.current_timeout = reset_timeout
+        self._probe_in_flight = False
+        BREAKER_STATE.set(STATE_VALUES[CLOSED], host=name)
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        BREAKER_STATE.set(STATE_VALUES[state], host=self.name)
+        BREAKER_TRANSITIONS.inc(host=self.name, state=state)
+        print(f"⚡ Предохранитель {self.name}: {state}")
+
+    @property
+    def is_open(self):
+        """Сайт считается недоступным (разомкнут или идет проба)"""
+        return self.state != CLOSED
+
+    def retry_in(self):
+        """Через сколько секунд будет разрешена проба (0, если запросы разрешены)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.current_timeout - time.monotonic())
+
+    def allow(self):
+        """Можно ли выполнить запрос сейчас (в состоянии пробы - только один)"""
+        if self.state == OPEN:
+            if self.retry_in() > 0:
+                return False
+            self._transition(HALF_OPEN)
+            self._probe_in_flight = False
+
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.current_timeout = self.reset_timeout
+        self._probe_in_flight = False
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            # Неудачная проба: пауза до следующей растет
+            self.current_timeout = min(self.current_timeout * 2, self.max_reset_timeout)
+        elif self.consecutive_failures < self.failures:
+            return
+
+        self._probe_in_flight = False
+        self.opened_at = time.monotonic()
+        self._transition(OPEN)
+
+    def describe(self):
+        """Состояние предохранителя для админа"""
+        if self.state == CLOSED:
+            return f"✅ {self.name}: доступен"
+        if self.state == HALF_OPEN:
+            return f"🔎 {self.name}: проверка доступности"
+        return (f"⚡ {self.name}: недоступен, ошибок подряд {self.consecutive_failures}, "
+                f"следующая проверка через {self.retry_in():.0f} с")
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from aiogram.exceptions import (TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+                                TelegramNetworkError, TelegramRetryAfter, TelegramServerError)
+
+from config import BROADCAST_RATE, BROADCAST_CHAT_INTERVAL, BROADCAST_RETRIES
+from metrics import MESSAGES_TOTAL
+from ratelimit import TokenBucket
+
+# Результаты отправки одного сообщения
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+# Telegram отклонил само сообщение (например, неверная разметка): повтор не поможет
+REJECTED = 'rejected'
+
+
+@dataclass
+class BroadcastStats:
+    """Ход и итоги рассылки"""
+
+    total: int
+    sent: int = 0
+    failed: int = 0
+    # Пользователи, заблокировавшие бота или удалившие аккаунт
+    blocked: list = field(default_factory=list)
+    retries: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: float = None
+
+    @property
+    def done(self):
+        return self.sent + self.failed + len(self.blocked)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """Скорость отправки в сообщениях в секунду"""
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def format(self):
+        return (f"{self.done}/{self.total}, отправлено {self.sent}, ошибок {self.failed}, "
+                f"заблокировали {len(self.blocked)}, {self.elapsed:.1f} с ({self.rate:.1f} сообщ/с)")
+
+
+class Broadcaster:
+    """Рассылка несколькими отправителями в пределах лимитов Telegram.
+
+    Общее ведро токенов ограничивает скорость по всем чатам, отдельный интервал -
+    частоту сообщений в один чат. TelegramRetryAfter останавливает ведро для всех
+    отправителей, сетевые ошибки и ошибки сервера повторяются с экспоненциальной паузой.
+    """
+
+    def __init__(self, bot, rate=BROADCAST_RATE, chat_interval=BROADCAST_CHAT_INTERVAL, retries=BROADCAST_RETRIES):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self._chat_next = {}
+
+    async def _wait_chat(self, chat_id):
+        """Выдержать интервал между сообщениями в один чат"""
+        now = time.monotonic()
+        start = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = start + self.chat_interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def send(self, chat_id, text, stats=None, **kwargs):
+        """Отправить одно сообщение с учетом лимитов и повторов, вернуть SENT, FAILED, BLOCKED или REJECTED"""
+        result = await self._send(chat_id, text, stats, **kwargs)
+        MESSAGES_TOTAL.inc(result=result)
+        return result
+
+    async def _send(self, chat_id, text, stats, **kwargs):
+        attempt = 0
+        while True:
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return SENT
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать: останавливаем всех отправителей, попытку не считаем
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                # Бот заблокирован или аккаунт удален
+                return BLOCKED
+            except TelegramBadRequest as e:
+                if 'chat not found' in e.message.lower():
+                    return BLOCKED
+                print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                return REJECTED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.retries:
+                    print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                    return FAILED
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+            except TelegramAPIError as e:
+                print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                return FAILED
+
+            if stats is not None:
+                stats.retries += 1
+
+    def prune_chat_intervals(self):
+        """Забыть истекшие интервалы чатов: они нужны только во время рассылки"""
+        now = time.monotonic()
+        self._chat_next = {chat_id: t for chat_id, t in self._chat_next.items() if t > now}
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from config import SNAPSHOT_TTL, SNAPSHOT_MAX_STALE
+
+
+class SnapshotCache:
+    """Общий для процесса кэш снимка рейтинга.
+
+    Пока снимок свежее ttl, он отдается всем без обращения к сайту.
+    Устаревший снимок (не старше ttl + max_stale, любой, пока serve_stale()
+    возвращает True или загрузка уже идет) отдается сразу, а новый загружается
+    в фоне. Без снимка конкурентные запросы ждут одну общую загрузку и получают
+    ее результат.
+    """
+
+    def __init__(self, loader, ttl=SNAPSHOT_TTL, max_stale=SNAPSHOT_MAX_STALE, serve_stale=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.serve_stale = serve_stale or (lambda: False)
+        self._data = None
+        self._loaded_at = 0.0
+        self._inflight = None
+
+    def peek(self):
+        """Последний загруженный снимок без обращения к сайту"""
+        return self._data
+
+    def age(self):
+        """Сколько секунд назад загружен снимок (None, если снимка нет)"""
+        return time.monotonic() - self._loaded_at if self._data is not None else None
+
+    def prime(self, data, age):
+        """Положить снимок, полученный не с сайта (например, из базы при запуске), с его возрастом"""
+        if self._data is None:
+            self._data = data
+            self._loaded_at = time.monotonic() - age
+
+    def is_fresh(self):
+        """Снимок есть и его время жизни не истекло"""
+        return self._data is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self, force=False):
+        """Получить снимок, при необходимости дождавшись общей загрузки.
+
+        force - всегда дождаться новой загрузки и вернуть ее результат (None при ошибке).
+        """
+        if force:
+            return await self._refresh()
+
+        if self.is_fresh():
+            return self._data
+
+        if self._data is not None and (self.age() < self.ttl + self.max_stale or self.serve_stale()
+                                       or self._inflight is not None):
+            self.revalidate()
+            return self._data
+
+        data = await self._refresh()
+        # Если загрузка не удалась, последний удачный снимок лучше, чем ничего
+        return data if data is not None else self._data
+
+    def revalidate(self):
+        """Запустить фоновую загрузку, если она еще не идет"""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._load())
+            self._inflight.add_done_callback(self._log_error)
+
+    async def _refresh(self):
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._load())
+
+        # shield: отмена одного ожидающего не должна отменять общую загрузку
+        return await asyncio.shield(self._inflight)
+
+    @staticmethod
+    def _log_error(future):
+        # Ошибку фоновой загрузки никто не ждет: выводим ее здесь
+        if not future.cancelled() and future.exception() is not None:
+            print(f"❌ Ошибка фонового обновления снимка: {future.exception()}")
+
+    async def _load(self):
+        try:
+            data = await self.loader()
+            if data is not None:
+                self._data = data
+                self._loaded_at = time.monotonic()
+            return data
+        finally:
+            self._inflight = None
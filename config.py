@@ -1,4 +1,7 @@
 import os
+import re
+from datetime import datetime
+from urllib.parse import urlparse
 
 # Bot token from BotFather - ТОЛЬКО через переменные окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -9,34 +12,209 @@ ADMIN_ID = os.getenv("ADMIN_ID")
 # URL for parsing
 ITMO_URL = os.getenv("ITMO_URL", "https://abit.itmo.ru/ranking/bachelor/contract/2196")
 
+# Несколько программ для отслеживания через запятую (по умолчанию только ITMO_URL)
+ITMO_URLS = [url.strip() for url in (os.getenv("ITMO_URLS") or ITMO_URL).split(',') if url.strip()]
+
+
+def program_id(url):
+    """Идентификатор программы по URL: путь после /ranking/, например bachelor/contract/2196"""
+    path = urlparse(url).path.strip('/')
+    return path.split('ranking/', 1)[-1]
+
+
+# Программы: идентификатор -> URL. Первая программа используется по умолчанию
+PROGRAMS = {program_id(url): url for url in ITMO_URLS}
+DEFAULT_PROGRAM = next(iter(PROGRAMS))
+
+# Не больше HOST_CONCURRENCY одновременных запросов к одному сайту
+# и не чаще одного запроса в FETCH_DELAY секунд
+HOST_CONCURRENCY = int(os.getenv("HOST_CONCURRENCY", "2"))
+FETCH_DELAY = float(os.getenv("FETCH_DELAY", "1.0"))
+
+# Интервал парсинга по расписанию (сек): после изменений - минимальный, пока страница
+# не меняется, он удваивается до максимального. SCHEDULE_JITTER - случайный разброс (доля)
+SCHEDULE_MIN_INTERVAL = int(os.getenv("SCHEDULE_MIN_INTERVAL", "600"))
+SCHEDULE_MAX_INTERVAL = int(os.getenv("SCHEDULE_MAX_INTERVAL", "7200"))
+SCHEDULE_JITTER = float(os.getenv("SCHEDULE_JITTER", "0.1"))
+
+# Интервалы в пиковые окна (например, последние дни приема документов).
+# PEAK_WINDOWS: "2025-08-01 09:00/2025-08-04 18:00;2025-08-10/2025-08-11" (МСК)
+PEAK_MIN_INTERVAL = int(os.getenv("PEAK_MIN_INTERVAL", "120"))
+PEAK_MAX_INTERVAL = int(os.getenv("PEAK_MAX_INTERVAL", "600"))
+
+
+def parse_windows(value):
+    """Пиковые окна по московскому времени: начало/конец через точку с запятой"""
+    windows = []
+    for window in filter(None, (part.strip() for part in value.split(';'))):
+        try:
+            start, end = (datetime.fromisoformat(moment.strip()) for moment in window.split('/'))
+        except ValueError:
+            raise ValueError(f"❌ ОШИБКА: неверное пиковое окно в PEAK_WINDOWS: {window}") from None
+        if end <= start:
+            raise ValueError(f"❌ ОШИБКА: пиковое окно заканчивается раньше, чем начинается: {window}")
+        windows.append((start, end))
+    return windows
+
+
+PEAK_WINDOWS = parse_windows(os.getenv("PEAK_WINDOWS", ""))
+
+# Таймаут запроса к сайту ИТМО в секундах
+FETCH_TIMEOUT = int(os.getenv("FETCH_TIMEOUT", "30"))
+
+# Повторы запроса при сетевых ошибках, таймаутах и ответах 5xx/429:
+# пауза перед повтором растет вдвое, начиная с FETCH_BACKOFF секунд;
+# все попытки вместе укладываются в FETCH_TIMEOUT
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "2"))
+FETCH_BACKOFF = float(os.getenv("FETCH_BACKOFF", "1.0"))
+
+# Предохранитель: после BREAKER_FAILURES неудачных запросов подряд сайт не запрашивается
+# BREAKER_RESET секунд (после каждой неудачной пробы пауза удваивается до BREAKER_MAX_RESET)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "60"))
+BREAKER_MAX_RESET = float(os.getenv("BREAKER_MAX_RESET", "900"))
+
+# Бэкенд разбора страницы: auto, lxml, streaming или bs4 (исходный, самый медленный)
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "auto")
+
+# Время жизни общего снимка рейтинга в секундах
+SNAPSHOT_TTL = int(os.getenv("SNAPSHOT_TTL", "60"))
+
+# Устаревший не больше чем на SNAPSHOT_MAX_STALE секунд снимок отдается сразу, а обновляется
+# в фоне; пока сайт недоступен (предохранитель разомкнут), отдается снимок любой давности
+SNAPSHOT_MAX_STALE = int(os.getenv("SNAPSHOT_MAX_STALE", "600"))
+
+# Рассылка: сообщений в секунду на весь бот, число параллельных отправителей,
+# минимальный интервал между сообщениями в один чат (сек) и число повторов при сбоях сети
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+
+# Очередь исходящих сообщений: размер пачки, интервал проверки очереди (сек),
+# число попыток для сообщения, начальная пауза перед повтором (сек) и срок хранения отправленных (дни)
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = int(os.getenv("OUTBOX_RETRY_DELAY", "60"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Сколько секунд /broadcast показывает ход рассылки, если очередь перестала продвигаться
+OUTBOX_STALL_TIMEOUT = int(os.getenv("OUTBOX_STALL_TIMEOUT", "120"))
+
 # Database file
-DB_FILE = "data/database.db"
+DB_FILE = os.getenv("DB_FILE", "data/database.db")
+
+# Архив загруженных страниц рейтинга (пустое значение - не сохранять страницы)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(DB_FILE), "archive"))
+
+# Хранение истории рейтинга: записи старше RATING_RAW_RETENTION_DAYS дней прореживаются
+# до последней записи за день, часовые сводки хранятся RATING_HOURLY_RETENTION_DAYS дней
+# (0 - хранить без ограничений). Дневные сводки хранятся всегда
+RATING_RAW_RETENTION_DAYS = int(os.getenv("RATING_RAW_RETENTION_DAYS", "30"))
+RATING_HOURLY_RETENTION_DAYS = int(os.getenv("RATING_HOURLY_RETENTION_DAYS", "180"))
+
+# Число постоянных соединений с базой и ожидание блокировки записи в миллисекундах
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))
+
+# Активность пользователей пишется в базу пакетами: раз в ACTIVITY_FLUSH_INTERVAL секунд
+# или как только в буфере наберется ACTIVITY_FLUSH_SIZE пользователей
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+ACTIVITY_FLUSH_SIZE = int(os.getenv("ACTIVITY_FLUSH_SIZE", "500"))
+
+# Ограничение запросов: у каждого пользователя THROTTLE_USER_RATE запросов в секунду
+# с запасом THROTTLE_USER_BURST, у всего бота - THROTTLE_GLOBAL_RATE с запасом THROTTLE_GLOBAL_BURST.
+# Состояние хранится для THROTTLE_MAX_USERS недавно активных пользователей
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "0.5"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "30"))
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "60"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "50000"))
+
+# HTTP сервер метрик Prometheus и проверки /healthz (METRICS_PORT=0 - выключен,
+# healthcheck в docker-compose.yml тогда ничего не проверяет)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8080"))
+
+# /healthz сообщает о проблеме, если парсинга не было HEALTH_SCRAPE_AGE секунд,
+# long polling не получал ответа HEALTH_POLL_AGE секунд или event loop завис на HEALTH_LOOP_LAG секунд
+HEALTH_SCRAPE_AGE = int(os.getenv("HEALTH_SCRAPE_AGE", str(SCHEDULE_MAX_INTERVAL * 3)))
+HEALTH_POLL_AGE = int(os.getenv("HEALTH_POLL_AGE", "120"))
+HEALTH_LOOP_LAG = float(os.getenv("HEALTH_LOOP_LAG", "5"))
+
+# Получение обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook: публичный URL (пустой - webhook не регистрируется в Telegram, удобно для
+# локальной проверки), путь, адрес, на котором слушает сервер, и секрет из заголовка
+# X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Сколько обновлений обрабатывается одновременно (в обоих режимах)
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", "32"))
+
+# Роль процесса: all - все сразу, bot - только ответы пользователям,
+# worker - только парсинг, уведомления и обслуживание базы.
+# Парсит и рассылает только процесс, удерживающий блокировку LEADER_LOCK_FILE,
+# остальные проверяют ее каждые LEADER_RETRY_INTERVAL секунд
+ROLE = os.getenv("ROLE", "all")
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", os.path.join(os.path.dirname(DB_FILE), "leader.lock"))
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "2"))
 
 # Headers for requests
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 
-# Проверяем наличие обязательных переменных
-if not BOT_TOKEN:
-    raise ValueError("❌ КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения BOT_TOKEN не установлена!")
+# Конвертируем ADMIN_ID в int если он установлен (неверное значение отклонит validate)
+if ADMIN_ID and ADMIN_ID.strip().isdigit():
+    ADMIN_ID = int(ADMIN_ID)
+
+# Сколько секунд допустимо от запуска процесса до готовности принимать обновления:
+# импорт aiogram (около 2,5-3 с) и один запрос к Telegram, остальное идет параллельно
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "5"))
+
 
-if not BOT_TOKEN.startswith(('1', '2', '3', '4', '5', '6', '7', '8', '9')):
-    raise ValueError("❌ ОШИБКА: BOT_TOKEN должен начинаться с цифры")
+def validate():
+    """Проверить обязательные и взаимосвязанные настройки (вызывается при запуске бота, а не при импорте)"""
+    if not BOT_TOKEN:
+        raise ValueError("❌ КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения BOT_TOKEN не установлена!")
 
-if ':' not in BOT_TOKEN:
-    raise ValueError("❌ ОШИБКА: BOT_TOKEN должен содержать символ ':'")
+    if not BOT_TOKEN.startswith(('1', '2', '3', '4', '5', '6', '7', '8', '9')):
+        raise ValueError("❌ ОШИБКА: BOT_TOKEN должен начинаться с цифры")
 
-# Конвертируем ADMIN_ID в int если он установлен
-if ADMIN_ID:
-    try:
-        ADMIN_ID = int(ADMIN_ID)
-    except ValueError:
+    if ':' not in BOT_TOKEN:
+        raise ValueError("❌ ОШИБКА: BOT_TOKEN должен содержать символ ':'")
+
+    if ADMIN_ID and not isinstance(ADMIN_ID, int):
         raise ValueError("❌ ОШИБКА: ADMIN_ID должен быть числом")
 
-# Логи для отладки (БЕЗ отображения токена!)
-print(f"✅ Конфигурация загружена:")
-print(f"📱 BOT_TOKEN: {'✅ Установлен' if BOT_TOKEN else '❌ Не установлен'}")
-print(f"👑 ADMIN_ID: {'✅ Установлен' if ADMIN_ID else '❌ Не установлен'}")
-print(f"🔗 ITMO_URL: {ITMO_URL}")
-print(f"📁 DB_FILE: {DB_FILE}")
\ No newline at end of file
+    if ROLE not in ('all', 'bot', 'worker'):
+        raise ValueError("❌ ОШИБКА: ROLE должен быть all, bot или worker")
+
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError("❌ ОШИБКА: BOT_MODE должен быть polling или webhook")
+
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        raise ValueError("❌ ОШИБКА: в режиме webhook нужна переменная WEBHOOK_SECRET")
+
+    if WEBHOOK_SECRET and not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        raise ValueError("❌ ОШИБКА: WEBHOOK_SECRET может содержать только латинские буквы, цифры, _ и -")
+
+
+def print_summary():
+    """Логи для отладки (БЕЗ отображения токена!)"""
+    print(f"✅ Конфигурация загружена:")
+    print(f"📱 BOT_TOKEN: {'✅ Установлен' if BOT_TOKEN else '❌ Не установлен'}")
+    print(f"👑 ADMIN_ID: {'✅ Установлен' if ADMIN_ID else '❌ Не установлен'}")
+    print(f"🧭 ROLE: {ROLE}")
+    print(f"📡 BOT_MODE: {BOT_MODE}")
+    print(f"🔗 Программы ({len(PROGRAMS)}): {', '.join(PROGRAMS)}")
+    print(f"🧩 PARSER_BACKEND: {PARSER_BACKEND}")
+    print(f"⏱️ SNAPSHOT_TTL: {SNAPSHOT_TTL} сек")
+    print(f"📁 DB_FILE: {DB_FILE}")
+    print(f"📦 ARCHIVE_DIR: {ARCHIVE_DIR or 'отключен'}")
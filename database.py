@@ -1,19 +1,165 @@
+import asyncio
 import aiosqlite
 import os
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
+from types import MappingProxyType
 import pytz
-from config import DB_FILE
+from config import (DB_FILE, DEFAULT_PROGRAM, DB_POOL_SIZE, DB_BUSY_TIMEOUT,
+                    ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_SIZE,
+                    OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY, OUTBOX_RETENTION_DAYS,
+                    RATING_RAW_RETENTION_DAYS, RATING_HOURLY_RETENTION_DAYS)
+from snapshot import Position, RatingSnapshot, UserPosition
+from metrics import DB_SECONDS
 
 # Московская временная зона
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
+# Смещение Москвы от UTC в секундах: границы дней в сводках - московская полночь
+MOSCOW_OFFSET = 3 * 3600
+
+# Таблицы сводок рейтинга и размер их интервала в секундах
+ROLLUP_TABLES = {'rating_hourly': 3600, 'rating_daily': 86400}
+
+# Как часто прореживать старую историю, сек
+RETENTION_INTERVAL = 6 * 3600
+
+# Пул постоянных соединений (создается в init_database)
+_pool = None
+_pool_connections = []
+_pool_lock = asyncio.Lock()
+
+# Буфер активности пользователей до записи в базу:
+# user_id -> [username, first_name, last_name, первое сообщение, последнее сообщение, число сообщений]
+_activity_buffer = {}
+_activity_flush_lock = asyncio.Lock()
+_activity_flush_requested = asyncio.Event()
+
+# Позиции абитуриентов последнего сохраненного снимка по программам (основа для дельты)
+_applicant_states = {}
+
+# Последняя запись rating_history по программам: (id, отпечаток строк рейтинга)
+_last_records = {}
+
+
+async def _open_connection():
+    """Открыть соединение с WAL и настройками для конкурентного доступа"""
+    # cached_statements: подготовленные запросы переиспользуются, пока соединение живо
+    db = await aiosqlite.connect(DB_FILE, cached_statements=256)
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT}')
+    return db
+
+
+async def _open_pool():
+    """Создать пул соединений, если его еще нет"""
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            return
+
+        db_dir = os.path.dirname(DB_FILE)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        pool = asyncio.Queue()
+        for _ in range(DB_POOL_SIZE):
+            db = await _open_connection()
+            _pool_connections.append(db)
+            pool.put_nowait(db)
+        _pool = pool
+
+
+@asynccontextmanager
+async def connection():
+    """Взять соединение из пула на время операции"""
+    if _pool is None:
+        await _open_pool()
+
+    db = await _pool.get()
+    try:
+        yield db
+    finally:
+        # Незавершенная транзакция не должна перейти к следующему пользователю соединения
+        if db.in_transaction:
+            await db.rollback()
+        _pool.put_nowait(db)
+
+
+async def close_database():
+    """Записать накопленную активность и закрыть все соединения пула при остановке бота"""
+    global _pool
+    if _pool is not None:
+        await flush_activity()
+
+    async with _pool_lock:
+        for db in _pool_connections:
+            await db.close()
+        _pool_connections.clear()
+        _pool = None
+
+
+async def _ensure_column(db, table, column, definition):
+    """Добавить колонку в существующую таблицу, если ее еще нет"""
+    cursor = await db.execute(f'PRAGMA table_info({table})')
+    columns = [row[1] for row in await cursor.fetchall()]
+    if column in columns:
+        return False
+    await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def _to_epoch(value):
+    """Время из колонки timestamp (с часовым поясом или московское без него) в секунды эпохи"""
+    try:
+        moment = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = MOSCOW_TZ.localize(moment)
+    return int(moment.timestamp())
+
+
+def _bucket(ts, size):
+    """Начало часового или дневного (по Москве) интервала, в который попадает ts"""
+    return ts - (ts + MOSCOW_OFFSET) % size
+
+
+async def _update_rollups(db, rows):
+    """Учесть записи [(program, ts, total, contracts, paid, unpaid)] в часовых и дневных сводках.
+
+    Последние значения берутся у самой поздней записи интервала, поэтому
+    импортированные задним числом записи их не перезаписывают.
+    """
+    for table, size in ROLLUP_TABLES.items():
+        await db.executemany(f'''
+            INSERT INTO {table}
+            (program, bucket, samples, first_ts, last_ts, total_people, contract_count,
+             contract_paid_count, contract_unpaid_count, contract_min, contract_max)
+            VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(program, bucket) DO UPDATE SET
+                samples = samples + 1,
+                first_ts = MIN(first_ts, excluded.first_ts),
+                last_ts = MAX(last_ts, excluded.last_ts),
+                total_people = IIF(excluded.last_ts >= last_ts, excluded.total_people, total_people),
+                contract_count = IIF(excluded.last_ts >= last_ts, excluded.contract_count, contract_count),
+                contract_paid_count = IIF(excluded.last_ts >= last_ts, excluded.contract_paid_count,
+                                          contract_paid_count),
+                contract_unpaid_count = IIF(excluded.last_ts >= last_ts, excluded.contract_unpaid_count,
+                                            contract_unpaid_count),
+                contract_min = MIN(contract_min, excluded.contract_min),
+                contract_max = MAX(contract_max, excluded.contract_max)
+        ''', [(program, _bucket(ts, size), ts, ts, total, contracts, paid, unpaid, contracts, contracts)
+              for program, ts, total, contracts, paid, unpaid in rows])
+
 
 async def init_database():
-    """Инициализация базы данных"""
-    if not os.path.exists(os.path.dirname(DB_FILE)):
-        os.makedirs(os.path.dirname(DB_FILE))
+    """Инициализация базы данных и пула соединений"""
+    await _open_pool()
 
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         # Таблица пользователей
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -49,54 +195,261 @@ async def init_database():
             )
         ''')
 
+        # Программа записи (старые записи относятся к программе по умолчанию)
+        if await _ensure_column(db, 'rating_history', 'program', 'TEXT'):
+            await db.execute('UPDATE rating_history SET program = ? WHERE program IS NULL', (DEFAULT_PROGRAM,))
+
+        # Отпечаток строк рейтинга и время, когда такой рейтинг видели в последний раз:
+        # повторная загрузка той же страницы обновляет только last_seen
+        await _ensure_column(db, 'rating_history', 'fingerprint', 'TEXT')
+        await _ensure_column(db, 'rating_history', 'last_seen', 'TIMESTAMP')
+
+        # Время записи в секундах эпохи: в timestamp время хранится строкой и не индексируется
+        if await _ensure_column(db, 'rating_history', 'ts', 'INTEGER'):
+            cursor = await db.execute('SELECT id, timestamp FROM rating_history')
+            await db.executemany('UPDATE rating_history SET ts = ? WHERE id = ?',
+                                 [(_to_epoch(timestamp), row_id) for row_id, timestamp in await cursor.fetchall()])
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_rating_history_ts ON rating_history (ts)')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_rating_history_program_ts ON rating_history (program, ts)')
+
+        # Сводки по часам и дням (начало интервала в секундах эпохи): число записей,
+        # последние значения и размах числа договоров. Обновляются при каждой записи
+        # рейтинга, поэтому история за любой период читается без сканирования rating_history
+        rollups_created = False
+        for table in ROLLUP_TABLES:
+            cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            rollups_created = rollups_created or await cursor.fetchone() is None
+            await db.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    program TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    samples INTEGER NOT NULL,
+                    first_ts INTEGER NOT NULL,
+                    last_ts INTEGER NOT NULL,
+                    total_people INTEGER,
+                    contract_count INTEGER,
+                    contract_paid_count INTEGER,
+                    contract_unpaid_count INTEGER,
+                    contract_min INTEGER,
+                    contract_max INTEGER,
+                    PRIMARY KEY (program, bucket)
+                ) WITHOUT ROWID
+            ''')
+
+        # Новые сводки заполняются по уже накопленной истории
+        if rollups_created:
+            cursor = await db.execute('''
+                SELECT program, ts, total_people, contract_count, contract_paid_count, contract_unpaid_count
+                FROM rating_history WHERE ts IS NOT NULL ORDER BY ts
+            ''')
+            await _update_rollups(db, await cursor.fetchall())
+
+        # История позиций абитуриентов: хранятся только изменившиеся относительно
+        # предыдущего снимка строки, snapshot_id ссылается на rating_history.id,
+        # position = NULL означает, что абитуриент пропал из списка
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS applicant_history (
+                program TEXT NOT NULL,
+                application_id TEXT NOT NULL,
+                snapshot_id INTEGER NOT NULL,
+                position INTEGER,
+                contract_position INTEGER,
+                paid_position INTEGER,
+                unpaid_position INTEGER,
+                PRIMARY KEY (program, application_id, snapshot_id)
+            ) WITHOUT ROWID
+        ''')
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_applicant_history_snapshot ON applicant_history (program, snapshot_id)
+        ''')
+
+        # Позиции абитуриентов в последнем снимке программы: обновляются дельтой при сохранении
+        # снимка, поэтому последний снимок читается без прохода по всей applicant_history
+        cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'applicant_positions'")
+        positions_created = await cursor.fetchone() is None
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS applicant_positions (
+                program TEXT NOT NULL,
+                application_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                contract_position INTEGER,
+                paid_position INTEGER,
+                unpaid_position INTEGER,
+                PRIMARY KEY (program, application_id)
+            ) WITHOUT ROWID
+        ''')
+
+        # Новая таблица заполняется по уже накопленной истории: последняя дельта каждого абитуриента
+        # ищется по времени снимка (ts, id), а не по snapshot_id - импортированные записи получают новые id
+        if positions_created:
+            await db.execute('''
+                INSERT INTO applicant_positions
+                (program, application_id, position, contract_position, paid_position, unpaid_position)
+                SELECT program, application_id, position, contract_position, paid_position, unpaid_position
+                FROM (
+                    SELECT h.program, h.application_id, h.position, h.contract_position, h.paid_position,
+                           h.unpaid_position,
+                           ROW_NUMBER() OVER (PARTITION BY h.program, h.application_id
+                                              ORDER BY r.ts DESC, r.id DESC) AS rank
+                    FROM applicant_history h
+                    JOIN rating_history r ON r.id = h.snapshot_id
+                )
+                WHERE rank = 1 AND position IS NOT NULL
+            ''')
+
+        # Программы, которые отслеживает пользователь
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS user_programs (
+                user_id INTEGER,
+                program TEXT,
+                PRIMARY KEY (user_id, program)
+            )
+        ''')
+
+        # Позиции пользователей в последнем сохраненном снимке каждой программы:
+        # пересчитываются для всех пользователей с ID абитуриента при сохранении снимка.
+        # prev_* - позиции того же ID в предыдущем снимке (prev_known = 0, если они неизвестны)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS user_positions (
+                user_id INTEGER NOT NULL,
+                program TEXT NOT NULL,
+                snapshot_id INTEGER NOT NULL,
+                fingerprint TEXT,
+                your_id TEXT NOT NULL,
+                position INTEGER,
+                contract_position INTEGER,
+                paid_position INTEGER,
+                unpaid_position INTEGER,
+                prev_known INTEGER NOT NULL DEFAULT 0,
+                prev_position INTEGER,
+                prev_contract_position INTEGER,
+                prev_paid_position INTEGER,
+                prev_unpaid_position INTEGER,
+                PRIMARY KEY (user_id, program)
+            ) WITHOUT ROWID
+        ''')
+
+        # Время, когда пользователь заблокировал бота или удалил аккаунт (NULL - доступен)
+        await _ensure_column(db, 'users', 'blocked_at', 'TIMESTAMP')
+
+        # Очередь исходящих сообщений: строка удаляется из pending только после отправки,
+        # поэтому после перезапуска доставка продолжается с неотправленных.
+        # status: pending, sent, failed (кончились попытки) или dead (пользователь недоступен)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, id)')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_batch ON outbox (batch, status)')
+
         await db.commit()
 
 
-async def add_or_update_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Добавить или обновить пользователя"""
+def record_activity(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+    """Учесть сообщение пользователя в буфере; в базу оно попадет пакетом"""
     moscow_time = datetime.now(MOSCOW_TZ)
 
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Проверяем, существует ли пользователь
-        cursor = await db.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        user_exists = await cursor.fetchone()
+    entry = _activity_buffer.get(user_id)
+    if entry is None:
+        _activity_buffer[user_id] = [username, first_name, last_name, moscow_time, moscow_time, 1]
+    else:
+        entry[0:3] = username, first_name, last_name
+        entry[4] = moscow_time
+        entry[5] += 1
 
-        if user_exists:
-            # Обновляем существующего пользователя
-            await db.execute('''
-                UPDATE users 
-                SET username = ?, first_name = ?, last_name = ?, 
-                    last_activity = ?, message_count = message_count + 1
-                WHERE user_id = ?
-            ''', (username, first_name, last_name, moscow_time, user_id))
-        else:
-            # Добавляем нового пользователя
-            await db.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name, created_at, last_activity, message_count)
-                VALUES (?, ?, ?, ?, ?, ?, 1)
-            ''', (user_id, username, first_name, last_name, moscow_time, moscow_time))
+    # Большой буфер записываем, не дожидаясь интервала
+    if len(_activity_buffer) >= ACTIVITY_FLUSH_SIZE:
+        _activity_flush_requested.set()
 
-        await db.commit()
+
+@DB_SECONDS.timed()
+async def flush_activity():
+    """Записать буфер активности одним UPSERT в одной транзакции, вернуть число пользователей"""
+    async with _activity_flush_lock:
+        if not _activity_buffer:
+            return 0
+
+        batch = list(_activity_buffer.items())
+        _activity_buffer.clear()
+
+        try:
+            async with connection() as db:
+                await db.executemany('''
+                    INSERT INTO users (user_id, username, first_name, last_name, created_at, last_activity, message_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        last_activity = excluded.last_activity,
+                        message_count = message_count + excluded.message_count,
+                        blocked_at = NULL
+                ''', [(user_id, *entry) for user_id, entry in batch])
+                await db.commit()
+        except Exception:
+            # Возвращаем неуспешный пакет в буфер, не теряя сообщений, пришедших за это время
+            for user_id, entry in batch:
+                current = _activity_buffer.get(user_id)
+                if current is None:
+                    _activity_buffer[user_id] = entry
+                else:
+                    current[3] = entry[3]
+                    current[5] += entry[5]
+            raise
+
+        return len(batch)
+
+
+async def run_activity_flusher():
+    """Фоновая запись буфера активности каждые ACTIVITY_FLUSH_INTERVAL секунд или по заполнению"""
+    while True:
+        try:
+            await asyncio.wait_for(_activity_flush_requested.wait(), ACTIVITY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _activity_flush_requested.clear()
+
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"❌ Ошибка записи активности пользователей: {e}")
 
 
+@DB_SECONDS.timed()
 async def set_user_id(user_id: int, your_id: str):
     """Установить ID абитуриента для пользователя"""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('UPDATE users SET your_id = ? WHERE user_id = ?', (your_id, user_id))
+    async with connection() as db:
+        # Строки пользователя может еще не быть: активность записывается в базу с задержкой
+        await db.execute('''
+            INSERT INTO users (user_id, your_id) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET your_id = excluded.your_id
+        ''', (user_id, your_id))
         await db.commit()
 
 
+@DB_SECONDS.timed()
 async def get_user_id(user_id: int):
     """Получить ID абитуриента пользователя"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         cursor = await db.execute('SELECT your_id FROM users WHERE user_id = ?', (user_id,))
         result = await cursor.fetchone()
         return result[0] if result and result[0] else None
 
 
+@DB_SECONDS.timed()
 async def subscribe_user(user_id: int):
     """Подписать пользователя на уведомления"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         try:
             await db.execute('INSERT INTO subscriptions (user_id) VALUES (?)', (user_id,))
             await db.commit()
@@ -105,50 +458,403 @@ async def subscribe_user(user_id: int):
             return False
 
 
+@DB_SECONDS.timed()
 async def unsubscribe_user(user_id: int):
     """Отписать пользователя от уведомлений"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         cursor = await db.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
         await db.commit()
         return cursor.rowcount > 0
 
 
+@DB_SECONDS.timed()
 async def get_all_subscribers():
     """Получить всех подписчиков"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         cursor = await db.execute('SELECT user_id FROM subscriptions')
         rows = await cursor.fetchall()
         return [row[0] for row in rows]
 
 
-async def save_rating_data(data):
-    """Сохранить данные рейтинга"""
-    moscow_time = datetime.now(MOSCOW_TZ)
+@DB_SECONDS.timed()
+async def get_user_programs(user_id: int):
+    """Получить программы, которые отслеживает пользователь (без выбора - программа по умолчанию)"""
+    async with connection() as db:
+        cursor = await db.execute('SELECT program FROM user_programs WHERE user_id = ?', (user_id,))
+        rows = await cursor.fetchall()
+        return [row[0] for row in rows] or [DEFAULT_PROGRAM]
 
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT INTO rating_history 
-            (timestamp, total_people, contract_count, contract_paid_count, contract_unpaid_count)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (moscow_time, data['total_people'], data['contract_count'],
-              data['contract_paid_count'], data['contract_unpaid_count']))
+
+def _tracked_programs(programs, known=None):
+    """Выбранные программы, которые есть среди known (без них - программа по умолчанию)"""
+    return [program for program in programs if known is None or program in known] or [DEFAULT_PROGRAM]
+
+
+@DB_SECONDS.timed()
+async def toggle_user_program(user_id: int, program: str, known=None):
+    """Включить или выключить отслеживание программы одной транзакцией.
+
+    known - программы текущей конфигурации: остальные выбранные не учитываются.
+    Возвращает (новое состояние, отслеживаемые программы); последнюю программу
+    убрать нельзя, тогда состояние - None.
+    """
+    async with connection() as db:
+        cursor = await db.execute('SELECT program FROM user_programs WHERE user_id = ?', (user_id,))
+        programs = [row[0] for row in await cursor.fetchall()] or [DEFAULT_PROGRAM]
+
+        # Последнюю программу не убираем, иначе пользователь ничего не отслеживает
+        if _tracked_programs(programs, known) == [program]:
+            return None, [program]
+
+        if program in programs:
+            await db.execute('DELETE FROM user_programs WHERE user_id = ? AND program = ?', (user_id, program))
+            programs.remove(program)
+            enabled = False
+        else:
+            # Сохраняем и текущий выбор, если до этого использовалась программа по умолчанию
+            await db.executemany('INSERT OR IGNORE INTO user_programs (user_id, program) VALUES (?, ?)',
+                                 [(user_id, p) for p in programs + [program]])
+            programs.append(program)
+            enabled = True
         await db.commit()
+    return enabled, _tracked_programs(programs, known)
 
 
-async def get_last_contract_count():
-    """Получить последнее количество договоров"""
-    async with aiosqlite.connect(DB_FILE) as db:
+@DB_SECONDS.timed()
+async def get_program_subscribers(program: str):
+    """Подписчики программы с ID абитуриента и заранее посчитанными позициями:
+    [(user_id, your_id, UserPosition или None)]
+    """
+    async with connection() as db:
         cursor = await db.execute('''
-            SELECT contract_count FROM rating_history 
-            ORDER BY timestamp DESC LIMIT 1
-        ''')
-        result = await cursor.fetchone()
-        return result[0] if result else None
+            SELECT s.user_id, u.your_id,
+                   p.your_id, p.fingerprint, p.position, p.contract_position, p.paid_position, p.unpaid_position,
+                   p.prev_known, p.prev_position, p.prev_contract_position, p.prev_paid_position,
+                   p.prev_unpaid_position
+            FROM subscriptions s
+            LEFT JOIN users u ON u.user_id = s.user_id
+            LEFT JOIN user_positions p ON p.user_id = s.user_id AND p.program = ?
+            WHERE EXISTS (
+                SELECT 1 FROM user_programs up WHERE up.user_id = s.user_id AND up.program = ?
+            ) OR (? AND NOT EXISTS (
+                SELECT 1 FROM user_programs up WHERE up.user_id = s.user_id
+            ))
+        ''', (program, program, program == DEFAULT_PROGRAM))
+        return [(row[0], row[1], _user_position(row[2:]) if row[2] is not None else None)
+                for row in await cursor.fetchall()]
+
+
+async def _load_applicant_state(db, program):
+    """Позиции абитуриентов последнего снимка программы из applicant_positions"""
+    cursor = await db.execute('''
+        SELECT application_id, position, contract_position, paid_position, unpaid_position
+        FROM applicant_positions WHERE program = ?
+    ''', (program,))
+    return {row[0]: Position(*row[1:]) for row in await cursor.fetchall()}
+
+
+async def _load_last_record(db, program):
+    """Последняя запись rating_history программы: (id, отпечаток) или (None, None)"""
+    cursor = await db.execute('''
+        SELECT id, fingerprint FROM rating_history WHERE program = ? ORDER BY ts DESC, id DESC LIMIT 1
+    ''', (program,))
+    return await cursor.fetchone() or (None, None)
+
+
+async def _materialize_user_positions(db, program, snapshot_id, snapshot):
+    """Посчитать позиции всех пользователей с ID абитуриента в снимке одним проходом"""
+    absent = (None, None, None, None)
+    cursor = await db.execute('SELECT user_id, your_id FROM users WHERE your_id IS NOT NULL')
+    rows = [
+        (user_id, program, snapshot_id, snapshot.fingerprint, your_id) + tuple(snapshot.positions.get(your_id, absent))
+        for user_id, your_id in await cursor.fetchall()
+    ]
+
+    # В SET справа используются значения строки до обновления: текущие позиции становятся prev_*
+    await db.executemany('''
+        INSERT INTO user_positions
+        (user_id, program, snapshot_id, fingerprint, your_id,
+         position, contract_position, paid_position, unpaid_position)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, program) DO UPDATE SET
+            prev_known = your_id = excluded.your_id,
+            prev_position = CASE WHEN your_id = excluded.your_id THEN position END,
+            prev_contract_position = CASE WHEN your_id = excluded.your_id THEN contract_position END,
+            prev_paid_position = CASE WHEN your_id = excluded.your_id THEN paid_position END,
+            prev_unpaid_position = CASE WHEN your_id = excluded.your_id THEN unpaid_position END,
+            snapshot_id = excluded.snapshot_id,
+            fingerprint = excluded.fingerprint,
+            your_id = excluded.your_id,
+            position = excluded.position,
+            contract_position = excluded.contract_position,
+            paid_position = excluded.paid_position,
+            unpaid_position = excluded.unpaid_position
+    ''', rows)
+    return len(rows)
+
+
+def _user_position(row):
+    """UserPosition из колонок user_positions (your_id, fingerprint, 4 позиции, prev_known, 4 prev_*)"""
+    your_id, fingerprint = row[0], row[1]
+    position = Position(*row[2:6]) if row[2] is not None else None
+    previous = Position(*row[7:11]) if row[7] is not None else None
+    return UserPosition(your_id, fingerprint, position, previous, bool(row[6]))
+
+
+@DB_SECONDS.timed()
+async def get_user_positions(user_id: int):
+    """Заранее посчитанные позиции пользователя по программам: {program: UserPosition}"""
+    async with connection() as db:
+        cursor = await db.execute('''
+            SELECT program, your_id, fingerprint, position, contract_position, paid_position, unpaid_position,
+                   prev_known, prev_position, prev_contract_position, prev_paid_position, prev_unpaid_position
+            FROM user_positions WHERE user_id = ?
+        ''', (user_id,))
+        return {row[0]: _user_position(row[1:]) for row in await cursor.fetchall()}
+
+
+@DB_SECONDS.timed()
+async def save_rating_data(snapshot, moment=None):
+    """Сохранить снимок рейтинга: итоги и изменившиеся позиции абитуриентов.
+
+    Если рейтинг не изменился (тот же отпечаток или ответ 304), новая запись
+    не создается - у последней обновляется только last_seen. moment - время
+    снимка, если он сохраняется задним числом (например, при разборе архива).
+    """
+    moscow_time = moment or datetime.now(MOSCOW_TZ)
+    program = snapshot.program or DEFAULT_PROGRAM
+
+    async with connection() as db:
+        last = _last_records.get(program)
+        if last is None:
+            last = _last_records[program] = await _load_last_record(db, program)
+
+        last_id, last_fingerprint = last
+        if last_id is not None and (snapshot.not_modified or snapshot.fingerprint == last_fingerprint):
+            await db.execute('UPDATE rating_history SET last_seen = ? WHERE id = ?', (moscow_time, last_id))
+            await db.commit()
+            return last_id
+
+        previous = _applicant_states.get(program)
+        if previous is None:
+            previous = await _load_applicant_state(db, program)
+
+        totals = (snapshot.total_people, snapshot.contract_count,
+                  snapshot.contract_paid_count, snapshot.contract_unpaid_count)
+        ts = int(moscow_time.timestamp())
+        cursor = await db.execute('''
+            INSERT INTO rating_history
+            (program, timestamp, ts, total_people, contract_count, contract_paid_count, contract_unpaid_count,
+             fingerprint, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (program, moscow_time, ts) + totals + (snapshot.fingerprint, moscow_time))
+        snapshot_id = cursor.lastrowid
+        await _update_rollups(db, [(program, ts) + totals])
+
+        # Дельта: новые и изменившиеся строки, а также пропавшие из списка абитуриенты;
+        # ею же обновляются позиции последнего снимка
+        changed = [
+            (program, application_id, snapshot_id) + tuple(position)
+            for application_id, position in snapshot.positions.items()
+            if previous.get(application_id) != position
+        ]
+        changed.extend(
+            (program, application_id, snapshot_id, None, None, None, None)
+            for application_id in previous.keys() - snapshot.positions.keys()
+        )
+        await db.executemany('''
+            INSERT INTO applicant_history
+            (program, application_id, snapshot_id, position, contract_position, paid_position, unpaid_position)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', changed)
+        await db.executemany('''
+            INSERT OR REPLACE INTO applicant_positions
+            (program, application_id, position, contract_position, paid_position, unpaid_position)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [row[:2] + row[3:] for row in changed if row[3] is not None])
+        await db.executemany('DELETE FROM applicant_positions WHERE program = ? AND application_id = ?',
+                             [row[:2] for row in changed if row[3] is None])
+
+        # Позиции пользователей считаются в той же транзакции, что и снимок
+        await _materialize_user_positions(db, program, snapshot_id, snapshot)
+        await db.commit()
+
+    _applicant_states[program] = snapshot.positions
+    _last_records[program] = (snapshot_id, snapshot.fingerprint)
+    return snapshot_id
+
+
+def reset_snapshot_state():
+    """Забыть закэшированные последние снимки: их мог обновить другой процесс"""
+    _applicant_states.clear()
+    _last_records.clear()
+
+
+@DB_SECONDS.timed()
+async def load_last_snapshot(program: str):
+    """Восстановить последний сохраненный снимок программы (None, если истории позиций нет)"""
+    async with connection() as db:
+        cursor = await db.execute('''
+            SELECT id, COALESCE(last_seen, timestamp), total_people, contract_count, contract_paid_count,
+                   contract_unpaid_count, fingerprint
+            FROM rating_history
+            WHERE program = ?
+            ORDER BY ts DESC, id DESC LIMIT 1
+        ''', (program,))
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        last_id, *last = row
+
+        # Снимок мог сохранить другой процесс: позиции перечитываются, если последняя запись сменилась
+        positions = _applicant_states.get(program)
+        if positions is None or _last_records.get(program, (None, None))[0] != last_id:
+            positions = await _load_applicant_state(db, program)
+            _applicant_states[program] = positions
+            _last_records[program] = (last_id, last[5])
+
+    # Записи, сделанные до появления истории позиций, восстановить нельзя
+    if not positions and last[1]:
+        return None
+
+    # Строки без номера заявления не сохраняются, на их местах остаются пустые строки
+    items = [(None, False, False, False)] * (last[1] or 0)
+    for application_id, position in positions.items():
+        if position.overall <= len(items):
+            items[position.overall - 1] = (application_id, position.contract is not None,
+                                           position.paid is not None, position.unpaid is not None)
+
+    # Время снимка - последняя проверка рейтинга, как у снимков без изменений
+    return RatingSnapshot(
+        timestamp=str(last[0])[:19],
+        total_people=last[1],
+        contract_count=last[2],
+        contract_paid_count=last[3],
+        contract_unpaid_count=last[4],
+        items=tuple(items),
+        positions=MappingProxyType(dict(positions)),
+        program=program,
+        fingerprint=last[5]
+    )
+
+
+@DB_SECONDS.timed()
+async def get_applicant_timeline(program: str, application_id: str, limit: int = 20):
+    """Получить последние изменения позиции абитуриента (от старых к новым)"""
+    async with connection() as db:
+        cursor = await db.execute('''
+            SELECT r.timestamp, h.position, h.contract_position, h.paid_position, h.unpaid_position
+            FROM applicant_history h
+            JOIN rating_history r ON r.id = h.snapshot_id
+            WHERE h.program = ? AND h.application_id = ?
+            ORDER BY r.ts DESC, r.id DESC
+            LIMIT ?
+        ''', (program, application_id, limit))
+        rows = await cursor.fetchall()
+        return rows[::-1]
+
+
+@DB_SECONDS.timed()
+async def enqueue_messages(batch: str, messages):
+    """Поставить сообщения [(user_id, text, parse_mode)] в очередь отправки одной транзакцией"""
+    now = int(time.time())
+    async with connection() as db:
+        await db.executemany('''
+            INSERT INTO outbox (batch, user_id, text, parse_mode, available_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(batch, user_id, text, parse_mode, now, now) for user_id, text, parse_mode in messages])
+        await db.commit()
+    return len(messages)
+
+
+@DB_SECONDS.timed()
+async def fetch_outbox(limit: int):
+    """Очередная пачка неотправленных сообщений: [(id, user_id, text, parse_mode, attempts)]"""
+    async with connection() as db:
+        cursor = await db.execute('''
+            SELECT id, user_id, text, parse_mode, attempts FROM outbox
+            WHERE status = 'pending' AND available_at <= ?
+            ORDER BY id
+            LIMIT ?
+        ''', (int(time.time()), limit))
+        return await cursor.fetchall()
+
+
+@DB_SECONDS.timed()
+async def complete_outbox(sent_ids, failed, blocked_user_ids, rejected_ids=()):
+    """Записать итоги пачки одной транзакцией.
+
+    failed - [(id, attempts)]: сообщение возвращается в очередь с экспоненциальной паузой,
+    пока не кончатся попытки. Отклоненные Telegram сообщения (rejected_ids) сразу
+    переводятся в failed: повтор не поможет. Заблокировавшие бота пользователи помечаются недоступными,
+    теряют подписку, а их оставшиеся сообщения переводятся в dead.
+    """
+    now = int(time.time())
+    retry, exhausted = [], []
+    for message_id, attempts in failed:
+        attempts += 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            exhausted.append((attempts, now, message_id))
+        else:
+            retry.append((attempts, now + OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), now, message_id))
+
+    moscow_time = datetime.now(MOSCOW_TZ)
+    blocked = [(user_id,) for user_id in set(blocked_user_ids)]
+
+    async with connection() as db:
+        await db.executemany('''
+            UPDATE outbox SET status = 'sent', attempts = attempts + 1, updated_at = ? WHERE id = ?
+        ''', [(now, message_id) for message_id in sent_ids])
+        await db.executemany('''
+            UPDATE outbox SET attempts = ?, available_at = ?, updated_at = ? WHERE id = ?
+        ''', retry)
+        await db.executemany('''
+            UPDATE outbox SET status = 'failed', attempts = ?, updated_at = ? WHERE id = ?
+        ''', exhausted)
+        await db.executemany('''
+            UPDATE outbox SET status = 'failed', attempts = attempts + 1, updated_at = ? WHERE id = ?
+        ''', [(now, message_id) for message_id in rejected_ids])
+
+        await db.executemany('''
+            INSERT INTO users (user_id, blocked_at) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET blocked_at = excluded.blocked_at
+        ''', [(user_id, moscow_time) for user_id, in blocked])
+        await db.executemany('DELETE FROM subscriptions WHERE user_id = ?', blocked)
+        await db.executemany('''
+            UPDATE outbox SET status = 'dead', updated_at = ? WHERE user_id = ? AND status = 'pending'
+        ''', [(now, user_id) for user_id, in blocked])
+        await db.commit()
 
 
+@DB_SECONDS.timed()
+async def get_outbox_progress(batch: str):
+    """Число сообщений пачки по статусам: {'pending': ..., 'sent': ..., 'failed': ..., 'dead': ...}"""
+    async with connection() as db:
+        cursor = await db.execute('SELECT status, COUNT(*) FROM outbox WHERE batch = ? GROUP BY status', (batch,))
+        progress = {'pending': 0, 'sent': 0, 'failed': 0, 'dead': 0}
+        progress.update(dict(await cursor.fetchall()))
+        return progress
+
+
+@DB_SECONDS.timed()
+async def purge_outbox():
+    """Удалить обработанные сообщения старше OUTBOX_RETENTION_DAYS, вернуть их число"""
+    before = int(time.time()) - OUTBOX_RETENTION_DAYS * 86400
+    async with connection() as db:
+        cursor = await db.execute('''
+            DELETE FROM outbox WHERE status != 'pending' AND updated_at < ?
+        ''', (before,))
+        await db.commit()
+        return cursor.rowcount
+
+
+@DB_SECONDS.timed()
 async def get_user_stats():
     """Получить статистику пользователей (для админа)"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    # Сначала записываем буфер, чтобы итоги включали последние сообщения
+    await flush_activity()
+
+    async with connection() as db:
         # Общая статистика
         cursor = await db.execute('SELECT COUNT(*) FROM users')
         total_users = (await cursor.fetchone())[0]
@@ -159,6 +865,9 @@ async def get_user_stats():
         cursor = await db.execute('SELECT SUM(message_count) FROM users')
         total_messages = (await cursor.fetchone())[0] or 0
 
+        cursor = await db.execute('SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL')
+        total_blocked = (await cursor.fetchone())[0]
+
         # Топ активных пользователей
         cursor = await db.execute('''
             SELECT user_id, username, first_name, last_name, message_count, last_activity
@@ -172,19 +881,123 @@ async def get_user_stats():
             'total_users': total_users,
             'total_subscribers': total_subscribers,
             'total_messages': total_messages,
+            'total_blocked': total_blocked,
             'top_users': top_users
         }
 
 
+@DB_SECONDS.timed()
 async def get_rating_stats():
     """Получить статистику рейтинга (для админа)"""
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with connection() as db:
         cursor = await db.execute('''
-            SELECT timestamp, total_people, contract_count, contract_paid_count, contract_unpaid_count
+            SELECT timestamp, program, total_people, contract_count, contract_paid_count, contract_unpaid_count,
+                   last_seen
             FROM rating_history 
-            ORDER BY timestamp DESC 
+            ORDER BY ts DESC 
             LIMIT 10
         ''')
         recent_data = await cursor.fetchall()
 
-        return recent_data
\ No newline at end of file
+        return recent_data
+
+
+@DB_SECONDS.timed()
+async def get_rating_series(program: str, since: int):
+    """Число договоров и оплаченных с момента since и последнее значение до него: [(ts, договоров, оплачено)].
+
+    Записи без числа оплаченных (импорт старого CSV) пропускаются.
+    """
+    async with connection() as db:
+        cursor = await db.execute('''
+            SELECT ts, contract_count, contract_paid_count FROM rating_history
+            WHERE program = ? AND ts < ?
+              AND contract_count IS NOT NULL AND contract_paid_count IS NOT NULL
+            ORDER BY ts DESC LIMIT 1
+        ''', (program, since))
+        baseline = await cursor.fetchall()
+
+        cursor = await db.execute('''
+            SELECT ts, contract_count, contract_paid_count FROM rating_history
+            WHERE program = ? AND ts >= ?
+              AND contract_count IS NOT NULL AND contract_paid_count IS NOT NULL
+            ORDER BY ts
+        ''', (program, since))
+        return baseline + await cursor.fetchall()
+
+
+@DB_SECONDS.timed()
+async def get_rating_rollup(program: str, period: str = 'rating_daily', limit: int = 14):
+    """Последние сводки программы по дням или часам (от новых к старым):
+    [(начало интервала, записей, всего, договоров, оплачено, не оплачено, мин. договоров, макс. договоров)]
+    """
+    if period not in ROLLUP_TABLES:
+        raise ValueError(f"Неизвестная сводка: {period}")
+
+    async with connection() as db:
+        cursor = await db.execute(f'''
+            SELECT bucket, samples, total_people, contract_count, contract_paid_count, contract_unpaid_count,
+                   contract_min, contract_max
+            FROM {period}
+            WHERE program = ?
+            ORDER BY bucket DESC
+            LIMIT ?
+        ''', (program, limit))
+        return await cursor.fetchall()
+
+
+@DB_SECONDS.timed()
+async def apply_retention():
+    """Проредить старую историю, вернуть число удаленных записей rating_history.
+
+    Из записей старше RATING_RAW_RETENTION_DAYS остается последняя за каждый день.
+    Дельты позиций удаленной записи переносятся на оставшуюся запись того же дня,
+    если там нет более новой строки абитуриента, так что история позиций не рвется.
+    Сводки по дням не удаляются, по часам - после RATING_HOURLY_RETENTION_DAYS.
+    """
+    now = int(time.time())
+    removed = []
+
+    async with connection() as db:
+        if RATING_RAW_RETENTION_DAYS > 0:
+            cursor = await db.execute('''
+                SELECT id, program, ts FROM rating_history WHERE ts < ? ORDER BY ts, id
+            ''', (now - RATING_RAW_RETENTION_DAYS * 86400,))
+            rows = await cursor.fetchall()
+
+            # Последняя по времени запись дня остается, остальные сливаются в нее
+            # (id не годится: импортированные записи получают новые id при старом времени)
+            keep = {(program, _bucket(ts, 86400)): row_id for row_id, program, ts in rows}
+            removed = [(row_id, program, keep[(program, _bucket(ts, 86400))]) for row_id, program, ts in rows
+                       if keep[(program, _bucket(ts, 86400))] != row_id]
+
+            # От новых к старым: более новая дельта абитуриента не перезаписывается старой
+            for row_id, program, target in reversed(removed):
+                await db.execute('''
+                    INSERT OR IGNORE INTO applicant_history
+                    (program, application_id, snapshot_id, position, contract_position, paid_position, unpaid_position)
+                    SELECT program, application_id, ?, position, contract_position, paid_position, unpaid_position
+                    FROM applicant_history WHERE program = ? AND snapshot_id = ?
+                ''', (target, program, row_id))
+                await db.execute('DELETE FROM applicant_history WHERE program = ? AND snapshot_id = ?',
+                                 (program, row_id))
+            await db.executemany('DELETE FROM rating_history WHERE id = ?', [(row_id,) for row_id, _, _ in removed])
+
+        if RATING_HOURLY_RETENTION_DAYS > 0:
+            await db.execute('DELETE FROM rating_hourly WHERE bucket < ?',
+                             (now - RATING_HOURLY_RETENTION_DAYS * 86400,))
+        await db.commit()
+
+    return len(removed)
+
+
+async def run_retention():
+    """Фоновое прореживание истории раз в RETENTION_INTERVAL секунд"""
+    while True:
+        try:
+            removed = await apply_retention()
+            if removed:
+                print(f"🧹 История рейтинга прорежена: удалено записей {removed}")
+        except Exception as e:
+            print(f"❌ Ошибка прореживания истории: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
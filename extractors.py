@@ -0,0 +1,275 @@
+"""Бэкенды извлечения строк рейтинга из HTML страницы ИТМО.
+
+Каждый бэкенд за один проход по документу возвращает список строк
+(номер заявления, договор, оплачен, не оплачен) в порядке следования на странице.
+Если номер заявления не найден, строка имеет вид (None, False, False, False),
+но все равно занимает место в общем списке.
+
+Проверка совпадения бэкендов на сохраненных страницах (fixtures/ и переданных):
+    python -m extractors --check [page1.html page2.html]
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+from html.parser import HTMLParser
+
+# Сохраненные страницы рейтинга для проверки бэкендов
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# CSS классы страницы рейтинга (хэши меняются при обновлении фронтенда ИТМО)
+ITEM_CLASS = 'RatingPage_table__item__qMY0F'
+POSITION_CLASS = 'RatingPage_table__position__uYWvi'
+PAID_CLASS = 'RatingPage_table__item_green__InEVk'
+UNPAID_CLASS = 'RatingPage_table__item_yellow__lbs7n'
+CONTRACT_MARK = 'Договор: да'
+
+# Элементы без закрывающего тега (как в html.parser сборщике BeautifulSoup)
+VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer'
+])
+
+# Элементы, текст которых не попадает в get_text()
+NON_TEXT_TAGS = frozenset(['script', 'style', 'template', 'rt', 'rp'])
+
+_CHARSET_RE = re.compile(rb'charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+def _decode(content):
+    """Привести содержимое страницы к строке с учетом объявленной кодировки"""
+    if isinstance(content, str):
+        return content
+    match = _CHARSET_RE.search(content[:2048])
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return content.decode(encoding, errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+
+def _contract_flags(has_contract, markup):
+    """Тип договора по CSS классам элемента"""
+    if not has_contract:
+        return False, False
+    is_paid = PAID_CLASS in markup
+    is_unpaid = not is_paid and UNPAID_CLASS in markup
+    return is_paid, is_unpaid
+
+
+def extract_bs4(content):
+    """Исходный разбор через BeautifulSoup: строит полное дерево документа"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+    rows = []
+    for item in soup.find_all('div', class_=ITEM_CLASS):
+        position_element = item.find('p', class_=POSITION_CLASS)
+        span = position_element.find('span') if position_element else None
+        if span is None:
+            rows.append((None, False, False, False))
+            continue
+
+        has_contract = CONTRACT_MARK in item.get_text()
+        rows.append((span.text.strip(), has_contract) + _contract_flags(has_contract, str(item)))
+    return rows
+
+
+_LXML_ITEM_XPATH = f'//div[contains(concat(" ", normalize-space(@class), " "), " {ITEM_CLASS} ")]'
+_LXML_SPAN_XPATH = f'((.//p[contains(concat(" ", normalize-space(@class), " "), " {POSITION_CLASS} ")])[1]//span)[1]'
+
+
+def extract_lxml(content):
+    """Разбор через lxml и XPath: дерево строится в C, без сериализации элементов"""
+    from lxml import etree, html as lxml_html
+
+    root = lxml_html.document_fromstring(_decode(content))
+    # Текст скриптов и стилей не участвует в проверке договора, как и в get_text()
+    etree.strip_elements(root, *NON_TEXT_TAGS, with_tail=False)
+    rows = []
+    for item in root.xpath(_LXML_ITEM_XPATH):
+        spans = item.xpath(_LXML_SPAN_XPATH)
+        if not spans:
+            rows.append((None, False, False, False))
+            continue
+
+        has_contract = CONTRACT_MARK in item.text_content()
+        classes = ' '.join(element.get('class', '') for element in item.iter() if isinstance(element.tag, str))
+        rows.append((spans[0].text_content().strip(), has_contract) + _contract_flags(has_contract, classes))
+    return rows
+
+
+class _RatingTokenizer(HTMLParser):
+    """Потоковый разбор: дерево не строится, состояние хранится только для текущей строки"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self._stack = []
+        self._item_level = None
+
+    def _start_item(self):
+        self._item_level = len(self._stack)
+        self._text = []
+        self._attrs = []
+        self._position_level = None
+        self._position_seen = False
+        self._span_level = None
+        self._span_text = None
+        self._application_id = None
+
+    def _finish_item(self):
+        if self._application_id is None:
+            self.rows.append((None, False, False, False))
+        else:
+            has_contract = CONTRACT_MARK in ''.join(self._text)
+            self.rows.append((self._application_id, has_contract)
+                             + _contract_flags(has_contract, ' '.join(self._attrs)))
+        self._item_level = None
+
+    def handle_starttag(self, tag, attrs):
+        if self._item_level is None:
+            if tag != 'div':
+                if tag not in VOID_TAGS:
+                    self._stack.append(tag)
+                return
+            self._stack.append(tag)
+            class_attr = next((value for name, value in attrs if name == 'class' and value), '')
+            if ITEM_CLASS in class_attr.split():
+                self._start_item()
+                self._attrs.append(class_attr)
+            return
+
+        self._attrs.extend(value for name, value in attrs if value)
+        if tag in VOID_TAGS:
+            return
+        self._stack.append(tag)
+
+        if tag == 'p' and not self._position_seen:
+            class_attr = next((value for name, value in attrs if name == 'class' and value), '')
+            if POSITION_CLASS in class_attr.split():
+                self._position_seen = True
+                self._position_level = len(self._stack)
+        elif tag == 'span' and self._position_level is not None and self._span_text is None:
+            self._span_level = len(self._stack)
+            self._span_text = []
+
+    def handle_endtag(self, tag):
+        # Как и BeautifulSoup, закрываем ближайший открытый тег с этим именем вместе с вложенными
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index] == tag:
+                break
+        else:
+            return
+
+        while len(self._stack) > index:
+            level = len(self._stack)
+            self._stack.pop()
+            if self._item_level is None:
+                continue
+            if level == self._span_level:
+                self._application_id = ''.join(self._span_text).strip()
+                self._span_level = None
+            if level == self._position_level:
+                self._position_level = None
+            if level == self._item_level:
+                self._finish_item()
+
+    def handle_data(self, data):
+        if self._item_level is None or (self._stack and self._stack[-1] in NON_TEXT_TAGS):
+            return
+        self._text.append(data)
+        if self._span_level is not None:
+            self._span_text.append(data)
+
+    def close(self):
+        super().close()
+        # Незакрытые в конце документа теги закрываются неявно
+        if self._stack:
+            self.handle_endtag(self._stack[0])
+
+
+def extract_streaming(content):
+    """Потоковый токенизатор на html.parser из стандартной библиотеки"""
+    tokenizer = _RatingTokenizer()
+    tokenizer.feed(_decode(content))
+    tokenizer.close()
+    return tokenizer.rows
+
+
+EXTRACTORS = {
+    'bs4': extract_bs4,
+    'lxml': extract_lxml,
+    'streaming': extract_streaming
+}
+
+
+def lxml_available():
+    """Установлен ли lxml"""
+    try:
+        import lxml.html  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_extractor(name):
+    """Получить бэкенд по имени; auto выбирает lxml, а без него потоковый разбор"""
+    if name == 'auto':
+        name = 'lxml' if lxml_available() else 'streaming'
+    try:
+        return EXTRACTORS[name]
+    except KeyError:
+        raise ValueError(f"❌ ОШИБКА: неизвестный PARSER_BACKEND: {name}") from None
+
+
+def check_parity(content):
+    """Сравнить все доступные бэкенды с исходным bs4, вернуть список расхождений"""
+    expected = extract_bs4(content)
+    mismatches = []
+    for name, extractor in EXTRACTORS.items():
+        if name == 'bs4' or (name == 'lxml' and not lxml_available()):
+            continue
+        rows = extractor(content)
+        if rows != expected:
+            mismatches.append(name)
+    return expected, mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка совпадения бэкендов разбора на сохраненных страницах")
+    parser.add_argument('--check', action='store_true',
+                        help="Проверить страницы из fixtures/ (и переданные), код выхода 1 при расхождении")
+    parser.add_argument('paths', nargs='*', help="Сохраненные HTML страницы")
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.check or not paths:
+        paths = sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.html'))) + paths
+    if not paths:
+        print(f"❌ Нет страниц для проверки в {FIXTURES_DIR}")
+        return 1
+    if not lxml_available():
+        print("⚠️ lxml не установлен: бэкенд lxml не проверяется")
+
+    failed = False
+    for path in paths:
+        with open(path, 'rb') as f:
+            rows, mismatches = check_parity(f.read())
+        contracts = sum(1 for row in rows if row[1])
+        # Пустой результат у всех бэкендов - тоже ошибка: скорее всего, сменились CSS классы
+        if not rows:
+            status = "❌ строки рейтинга не найдены"
+        elif mismatches:
+            status = f"❌ расхождения: {', '.join(mismatches)}"
+        else:
+            status = '✅'
+        print(f"{path}: строк {len(rows)}, договоров {contracts} {status}")
+        failed = failed or not rows or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
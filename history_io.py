@@ -0,0 +1,228 @@
+"""Экспорт истории рейтинга в сжатый CSV и импорт старых CSV файлов.
+
+Экспорт читает таблицы порциями через курсор, поэтому память не растет вместе с
+историей. Импорт загружает строки пачками executemany в одной транзакции.
+
+Запуск из командной строки:
+    python history_io.py import data/ranking_history.csv [--program ...]
+    python history_io.py export data/export
+    python history_io.py check [data/ranking_history.csv]
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from config import DEFAULT_PROGRAM
+from database import (MOSCOW_TZ, connection, init_database, close_database,
+                      _to_epoch, _update_rollups)
+from metrics import DB_SECONDS
+
+# Сколько строк читается из курсора за раз при экспорте
+EXPORT_CHUNK_SIZE = 2000
+
+# Сколько строк передается в один executemany при импорте
+IMPORT_BATCH_SIZE = 1000
+
+# Экспортируемые таблицы: имя файла -> (заголовок CSV, запрос)
+EXPORTS = {
+    'rating_history': (
+        ('id', 'program', 'timestamp', 'ts', 'total_people', 'contract_count', 'contract_paid_count',
+         'contract_unpaid_count', 'fingerprint', 'last_seen'),
+        '''
+            SELECT id, program, timestamp, ts, total_people, contract_count, contract_paid_count,
+                   contract_unpaid_count, fingerprint, last_seen
+            FROM rating_history
+            WHERE ? IS NULL OR program = ?
+            ORDER BY program, ts
+        '''
+    ),
+    'applicant_history': (
+        ('program', 'application_id', 'snapshot_id', 'ts', 'position', 'contract_position',
+         'paid_position', 'unpaid_position'),
+        '''
+            SELECT h.program, h.application_id, h.snapshot_id, r.ts, h.position, h.contract_position,
+                   h.paid_position, h.unpaid_position
+            FROM applicant_history h
+            LEFT JOIN rating_history r ON r.id = h.snapshot_id
+            WHERE ? IS NULL OR h.program = ?
+            ORDER BY h.program, h.snapshot_id
+        '''
+    )
+}
+
+# Колонки rating_history, которые можно загрузить из CSV
+IMPORT_COLUMNS = ('total_people', 'contract_count', 'contract_paid_count', 'contract_unpaid_count')
+
+
+@DB_SECONDS.timed()
+async def export_history(directory, program=None):
+    """Выгрузить историю в directory/<таблица>.csv.gz, вернуть [(путь, число строк)]"""
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M%S')
+
+    results = []
+    async with connection() as db:
+        for table, (header, query) in EXPORTS.items():
+            path = os.path.join(directory, f'{table}_{stamp}.csv.gz')
+            rows = 0
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                cursor = await db.execute(query, (program, program))
+                while True:
+                    chunk = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.writerows(chunk)
+                    rows += len(chunk)
+                await cursor.close()
+            results.append((path, rows))
+    return results
+
+
+def _read_legacy_rows(file, program):
+    """Строки CSV в записи rating_history: (program, timestamp, ts, total, договоров, оплачено, не оплачено)"""
+    reader = csv.DictReader(file)
+    missing = {'timestamp', 'total_people', 'contract_count'} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"В CSV нет колонок: {', '.join(sorted(missing))}")
+
+    for line, row in enumerate(reader, 2):
+        ts = _to_epoch(row['timestamp'])
+        if ts is None:
+            print(f"⚠️ Строка {line}: не удалось разобрать время {row['timestamp']!r}, пропущена")
+            continue
+        values = tuple(int(row[column]) if row.get(column) not in (None, '') else None
+                       for column in IMPORT_COLUMNS)
+        yield (row.get('program') or program, row['timestamp'], ts) + values
+
+
+@DB_SECONDS.timed()
+async def import_history_csv(file, program=DEFAULT_PROGRAM):
+    """Загрузить записи рейтинга из CSV (старый ranking_history.csv или экспорт rating_history).
+
+    Записи с уже существующими программой и временем пропускаются, поэтому
+    повторный импорт того же файла ничего не дублирует. Возвращает (добавлено, прочитано).
+    """
+    rows = list(_read_legacy_rows(file, program))
+    return await insert_rating_rows(rows), len(rows)
+
+
+async def insert_rating_rows(rows):
+    """Добавить записи [(program, timestamp, ts, total, договоров, оплачено, не оплачено)] в rating_history.
+
+    Записи загружаются пачками executemany в одной транзакции, записи с уже
+    существующими программой и временем пропускаются. Возвращает число добавленных.
+    """
+    rows = sorted(rows, key=lambda row: row[2])
+    if not rows:
+        return 0
+
+    async with connection() as db:
+        # Уже загруженные записи ищутся только в интервале времени файла (по индексу program, ts)
+        programs = sorted({row[0] for row in rows})
+        cursor = await db.execute(f'''
+            SELECT program, ts FROM rating_history
+            WHERE program IN ({', '.join('?' * len(programs))}) AND ts BETWEEN ? AND ?
+        ''', (*programs, rows[0][2], rows[-1][2]))
+        seen = set(await cursor.fetchall())
+
+        new_rows = []
+        for row in rows:
+            if (row[0], row[2]) not in seen:
+                seen.add((row[0], row[2]))
+                new_rows.append(row)
+
+        for start in range(0, len(new_rows), IMPORT_BATCH_SIZE):
+            await db.executemany('''
+                INSERT INTO rating_history
+                (program, timestamp, ts, total_people, contract_count, contract_paid_count, contract_unpaid_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', new_rows[start:start + IMPORT_BATCH_SIZE])
+
+        await _update_rollups(db, [(row[0],) + row[2:] for row in new_rows])
+        await db.commit()
+
+    return len(new_rows)
+
+
+async def check_import(path, program=DEFAULT_PROGRAM):
+    """Проверка на временной базе: импорт CSV, живой снимок и восстановление окон аналитики.
+
+    Бросает исключение, если после импорта данные нельзя прочитать так же, как после парсинга.
+    """
+    import database
+    from analytics import VelocityTracker
+    from snapshot import RatingSnapshot
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.DB_FILE = os.path.join(directory, 'check.db')
+        await init_database()
+        try:
+            with open(path, encoding='utf-8', newline='') as file:
+                inserted, total = await import_history_csv(file, program)
+            print(f"✅ Импортировано записей: {inserted} из {total}")
+
+            items = (('1', True, True, False), ('2', False, False, False), ('3', True, False, True))
+            snapshot = RatingSnapshot.from_items(items, '', program)
+            await database.save_rating_data(snapshot)
+
+            tracker = VelocityTracker()
+            await tracker.rebuild([program], database.get_rating_series)
+            tracker.add(program, time.time(), snapshot.contract_count, snapshot.contract_paid_count)
+            tracker.get(program).rates()
+
+            last = await database.load_last_snapshot(program)
+            if last is None or last.fingerprint != snapshot.fingerprint:
+                raise RuntimeError("последний снимок после импорта - не последний сохраненный")
+        finally:
+            await close_database()
+    print("✅ Импортированная история читается так же, как записанная парсером")
+
+
+async def _main(args):
+    if args.command == 'check':
+        await check_import(args.path, args.program)
+        return
+
+    await init_database()
+    try:
+        if args.command == 'import':
+            opener = gzip.open if args.path.endswith('.gz') else open
+            with opener(args.path, 'rt', encoding='utf-8', newline='') as file:
+                inserted, total = await import_history_csv(file, args.program)
+            print(f"✅ Импортировано записей: {inserted} из {total}")
+        else:
+            for path, rows in await export_history(args.path, args.program):
+                print(f"✅ {path}: {rows} строк")
+    finally:
+        await close_database()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Экспорт и импорт истории рейтинга")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Загрузить CSV в rating_history")
+    import_parser.add_argument('path', help="CSV или CSV.GZ файл (например, data/ranking_history.csv)")
+    import_parser.add_argument('--program', default=DEFAULT_PROGRAM,
+                               help="Программа для строк без колонки program")
+
+    export_parser = subparsers.add_parser('export', help="Выгрузить историю в сжатые CSV")
+    export_parser.add_argument('path', help="Папка для файлов")
+    export_parser.add_argument('--program', default=None, help="Только одна программа")
+
+    check_parser = subparsers.add_parser('check', help="Проверить импорт на временной базе")
+    check_parser.add_argument('path', nargs='?', default='data/ranking_history.csv', help="CSV файл")
+    check_parser.add_argument('--program', default=DEFAULT_PROGRAM, help="Программа для строк CSV")
+
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Выбор единственного процесса, который парсит рейтинг и рассылает уведомления.
+
+Лидер держит эксклюзивную блокировку flock на файле рядом с базой. Блокировку
+снимает ядро, как только процесс завершается (в том числе по SIGKILL), поэтому
+следующий процесс становится лидером через LEADER_RETRY_INTERVAL секунд.
+Процессы должны видеть один и тот же файл: общий том на одной машине (на NFS
+flock ненадежен).
+"""
+import asyncio
+import fcntl
+import os
+import socket
+
+from config import LEADER_LOCK_FILE, LEADER_RETRY_INTERVAL
+
+
+class LeaderLease:
+    """Эксклюзивная блокировка файла: ее владелец - лидер"""
+
+    def __init__(self, path=LEADER_LOCK_FILE, retry_interval=LEADER_RETRY_INTERVAL):
+        self.path = path
+        self.retry_interval = retry_interval
+        self._file = None
+
+    @property
+    def is_leader(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        """Попробовать стать лидером без ожидания, вернуть True при успехе"""
+        if self._file is not None:
+            return True
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        file = open(self.path, 'a+')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+
+        # Кто лидер - видно по содержимому файла
+        file.seek(0)
+        file.truncate()
+        file.write(f"{socket.gethostname()} {os.getpid()}\n")
+        file.flush()
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def holder(self):
+        """Хост и PID текущего лидера (по содержимому файла блокировки)"""
+        try:
+            with open(self.path) as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    async def run(self, duties):
+        """Дождаться лидерства и выполнять duties (корутина без аргументов), пока задача не отменена.
+
+        Если duties завершились с ошибкой, лидерство освобождается и разыгрывается заново.
+        """
+        waiting = False
+        while True:
+            if not self.try_acquire():
+                if not waiting:
+                    print(f"⏸️ Парсинг выполняет другой процесс ({self.holder()}), ожидаем")
+                    waiting = True
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            waiting = False
+            print(f"👑 Процесс {os.getpid()} стал лидером: парсинг и рассылка выполняются здесь")
+            try:
+                await duties()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка в задачах лидера: {e}")
+            finally:
+                self.release()
+            await asyncio.sleep(self.retry_interval)
@@ -1,18 +1,41 @@
+import time
+
+# Момент запуска: от него считается время до готовности принимать обновления
+STARTED_AT = time.monotonic()
+
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from datetime import datetime
-import threading
-import time
+from aiogram.methods import GetUpdates
+from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton,
+                           FSInputFile)
+from datetime import datetime, timedelta
+from functools import partial
+import tempfile
 import pytz
 
-from config import BOT_TOKEN, ADMIN_ID
-from database import (init_database, add_or_update_user, set_user_id, get_user_id,
+from config import (BOT_TOKEN, ADMIN_ID, PROGRAMS, DEFAULT_PROGRAM, BOT_MODE, MAX_INFLIGHT_UPDATES, ROLE,
+                    OUTBOX_STALL_TIMEOUT, STARTUP_BUDGET, validate, print_summary)
+from database import (init_database, close_database, record_activity, run_activity_flusher, run_retention,
+                      set_user_id, get_user_id,
                       subscribe_user, unsubscribe_user, get_all_subscribers,
-                      save_rating_data, get_last_contract_count, get_user_stats, get_rating_stats)
-from parser import ITMOParser
+                      get_user_programs, toggle_user_program, get_program_subscribers, get_user_positions,
+                      save_rating_data, load_last_snapshot, get_applicant_timeline,
+                      enqueue_messages, get_outbox_progress, get_user_stats, get_rating_stats,
+                      get_rating_rollup, get_rating_series, reset_snapshot_state)
+from parser import ITMOParser, close_session, get_breaker
+from cache import SnapshotCache
+from broadcast import Broadcaster
+from outbox import OutboxWorker
+from scheduler import AdaptiveScheduler
+from analytics import VelocityTracker
+from leader import LeaderLease
+from throttle import Throttle
+import metrics
+from snapshot import diff_snapshots
 
 # Московская временная зона
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
@@ -27,12 +50,88 @@ logging.basicConfig(
 logging.getLogger('aiogram.dispatcher').setLevel(logging.WARNING)
 logging.getLogger('aiogram.bot').setLevel(logging.WARNING)
 
+# Настройки проверяются до создания бота: Bot сам отклоняет токен неверного формата
+validate()
+
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-# Глобальная переменная для event loop
-main_loop = None
+# Общий для всех рассылок отправитель: лимиты Telegram действуют на весь бот
+broadcaster = Broadcaster(bot)
+
+# Доставка уведомлений и рассылок из очереди в базе
+outbox = OutboxWorker(broadcaster)
+
+# Общие парсеры и кэши снимков рейтинга для всех обработчиков (по одному на программу)
+rating_parsers = {program: ITMOParser(url, program) for program, url in PROGRAMS.items()}
+
+
+# Фоновые задачи рассылки (ссылки хранятся, чтобы задачи не собрал сборщик мусора)
+background_tasks = set()
+
+# Темпы роста договоров по программам (обновляются при сохранении снимков)
+velocity = VelocityTracker()
+
+# Парсит и рассылает только лидер, остальные процессы читают снимки из базы
+lease = LeaderLease()
+
+
+async def load_snapshot(program):
+    """Загрузить свежий снимок рейтинга программы, сохранить его и уведомить об изменениях"""
+    previous = snapshot_caches[program].peek() or await load_last_snapshot(program)
+    parser = rating_parsers[program]
+
+    # После перезапуска сравниваем отпечаток с последним сохраненным снимком
+    if parser.last_snapshot is None:
+        parser.last_snapshot = previous
+
+    snapshot = await parser.fetch_snapshot()
+    if snapshot:
+        # Неизменившийся рейтинг только отмечается как проверенный (last_seen)
+        await save_rating_data(snapshot)
+        if not snapshot.not_modified:
+            velocity.add(program, time.time(), snapshot.contract_count, snapshot.contract_paid_count)
+
+        # Изменения ищутся при каждой новой загрузке, кто бы ее ни вызвал
+        if previous and not snapshot.not_modified:
+            diff = diff_snapshots(previous, snapshot)
+            if diff.contracts_changed:
+                task = asyncio.create_task(notify_users(diff))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+    return snapshot
+
+
+async def load_stored_snapshot(program):
+    """Последний снимок программы из базы (в процессах, которые не парсят сами)"""
+    previous = snapshot_caches[program].peek()
+    snapshot = await load_last_snapshot(program)
+
+    # Новый снимок сохранил лидер: окна аналитики перечитываются по индексу (program, ts)
+    if previous and snapshot and snapshot.fingerprint != previous.fingerprint:
+        await velocity.rebuild([program], get_rating_series)
+    return snapshot
+
+
+async def load_cached_snapshot(program):
+    """Загрузчик общего кэша: лидер загружает снимок с сайта, остальные берут его из базы"""
+    if lease.is_leader:
+        return await load_snapshot(program)
+    return await load_stored_snapshot(program)
+
+
+# Пока сайт недоступен, пользователи сразу получают последний удачный снимок
+snapshot_caches = {
+    program: SnapshotCache(partial(load_cached_snapshot, program), serve_stale=lambda url=url: get_breaker(url).is_open)
+    for program, url in PROGRAMS.items()
+}
+
+
+async def get_tracked_programs(user_id):
+    """Программы пользователя, которые есть в текущей конфигурации"""
+    programs = await get_user_programs(user_id)
+    return [program for program in programs if program in PROGRAMS] or [DEFAULT_PROGRAM]
 
 
 def get_moscow_time():
@@ -47,6 +146,84 @@ def format_moscow_time(dt=None):
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
+def format_position(snapshot, user_your_id, precomputed=None):
+    """Текст о позиции абитуриента в снимке рейтинга (precomputed - строка из user_positions)"""
+    if not user_your_id:
+        return "ℹ️ Установите свой ID в настройках для отслеживания позиции"
+
+    position = snapshot.user_position(user_your_id, precomputed)
+    if not position:
+        return f"❌ Ваш ID ({user_your_id}) не найден в списке"
+
+    your_pos_text = f"🎯 Ваша позиция: {position.overall}"
+    if position.contract:
+        your_pos_text += f"\n💼 Позиция среди договоров: {position.contract}"
+        if position.paid:
+            your_pos_text += f"\n💰 Позиция среди оплаченных: {position.paid}"
+        elif position.unpaid:
+            your_pos_text += f"\n⏳ Позиция среди неоплаченных: {position.unpaid}"
+    else:
+        your_pos_text += f"\n💼 У вас нет договора"
+    return your_pos_text
+
+
+def format_duration(seconds):
+    """Длительность в виде '2 д 5 ч' или '3 ч 20 мин'"""
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} д {hours} ч"
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    return f"{minutes} мин"
+
+
+def format_velocity(program):
+    """Темп роста договоров программы по скользящим окнам"""
+    tracker = velocity.get(program)
+    if tracker.last is None:
+        return "ℹ️ Данных для аналитики пока нет"
+
+    _, contracts, paid = tracker.last
+    lines = [f"📝 Договоры: {contracts}, 💰 оплачено: {paid}"]
+    for name, (contracts_delta, paid_delta, contracts_rate, paid_rate) in tracker.rates().items():
+        lines.append(f"{name}: договоры {contracts_delta:+d} ({contracts_rate:.1f}/ч), "
+                     f"оплачено {paid_delta:+d} ({paid_rate:.1f}/ч)")
+    return "\n".join(lines)
+
+
+def format_staleness(program):
+    """Пометка для устаревшего снимка: сколько ему и почему он не обновлен"""
+    cache = snapshot_caches[program]
+    age = cache.age()
+    if age is None or age < cache.ttl:
+        return ""
+    if get_breaker(PROGRAMS[program]).is_open:
+        return f"\n⚠️ Сайт ИТМО недоступен, показаны данные {format_duration(age)} назад"
+    return f"\n⏳ Данные получены {format_duration(age)} назад, обновляются"
+
+
+def format_program(program):
+    """Строка с названием программы (только если программ несколько)"""
+    return f"🎓 Программа: {program}\n" if len(PROGRAMS) > 1 else ""
+
+
+def format_my_id(your_id, programs, precomputed):
+    """Текст ответа на /my_id: позиции берутся из последних снимков без обращения к сайту"""
+    if not your_id:
+        return "❌ ID не установлен. Используйте /set_id <ваш_id> для установки."
+
+    text = f"🆔 Ваш текущий ID: {your_id}"
+    for program in programs:
+        snapshot = snapshot_caches[program].peek()
+        if snapshot:
+            position_text = format_position(snapshot, your_id, precomputed.get(program))
+            text += (f"\n\n{format_program(program)}{position_text}\n"
+                     f"🕐 По данным на {snapshot.timestamp} (МСК)")
+    return text
+
+
 # Создаем клавиатуры
 def get_main_keyboard():
     keyboard = ReplyKeyboardMarkup(
@@ -66,6 +243,8 @@ def get_admin_keyboard():
         inline_keyboard=[
             [InlineKeyboardButton(text="👥 Статистика пользователей", callback_data="admin_users")],
             [InlineKeyboardButton(text="📈 Статистика рейтинга", callback_data="admin_rating")],
+            [InlineKeyboardButton(text="📅 Рейтинг по дням", callback_data="admin_daily")],
+            [InlineKeyboardButton(text="⏰ Расписание парсинга", callback_data="admin_schedule")],
             [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
         ]
     )
@@ -76,18 +255,63 @@ def get_settings_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🆔 Установить ID", callback_data="set_id")],
-            [InlineKeyboardButton(text="👁️ Мой ID", callback_data="show_id")]
+            [InlineKeyboardButton(text="👁️ Мой ID", callback_data="show_id")],
+            [InlineKeyboardButton(text="🎓 Мои программы", callback_data="programs")]
         ]
     )
     return keyboard
 
 
+def get_programs_keyboard(selected):
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"{'✅' if program in selected else '▫️'} {program}",
+                                  callback_data=f"program:{program}")]
+            for program in PROGRAMS
+        ]
+    )
+    return keyboard
+
+
+class PollingWatch(BaseRequestMiddleware):
+    """Отмечает каждый успешный getUpdates: по нему /healthz видит, что long polling жив"""
+
+    async def __call__(self, make_request, bot, method):
+        response = await make_request(bot, method)
+        if isinstance(method, GetUpdates):
+            metrics.record_poll()
+        return response
+
+
+bot.session.middleware(PollingWatch())
+
+
+async def handler_metrics_middleware(handler, event, data):
+    """Длительность и ошибки каждого обработчика aiogram"""
+    name = data['handler'].callback.__name__
+    try:
+        with metrics.HANDLER_SECONDS.time(handler=name):
+            return await handler(event, data)
+    except Exception:
+        metrics.HANDLER_ERRORS.inc(handler=name)
+        raise
+
+
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
+# Ограничение частоты запросов: отклоненные не доходят до обработчиков и базы
+throttle = Throttle()
+dp.message.outer_middleware(throttle)
+dp.callback_query.outer_middleware(throttle)
+
+
 # Middleware для учета сообщений
 @dp.message.middleware()
 async def message_counter_middleware(handler, event, data):
-    """Middleware для подсчета сообщений пользователей"""
+    """Middleware для подсчета сообщений пользователей (запись в базу идет в фоне пакетами)"""
     if isinstance(event, types.Message) and event.from_user:
-        await add_or_update_user(
+        record_activity(
             event.from_user.id,
             event.from_user.username,
             event.from_user.first_name,
@@ -107,7 +331,8 @@ async def cmd_start(message: types.Message):
         f"📊 Проверить рейтинг - текущая статистика\n"
         f"🔔 Подписаться на уведомления - получать уведомления об изменениях\n"
         f"🔕 Отписаться от уведомлений - отключить уведомления\n"
-        f"⚙️ Настройки - установить свой ID абитуриента\n\n"
+        f"⚙️ Настройки - установить свой ID абитуриента\n"
+        f"📉 /history - как менялась ваша позиция\n\n"
         f"💡 Для отслеживания вашей позиции установите свой ID абитуриента в настройках!",
         reply_markup=get_main_keyboard()
     )
@@ -140,56 +365,88 @@ async def cmd_set_id(message: types.Message):
 @dp.message(Command("my_id"))
 async def cmd_my_id(message: types.Message):
     your_id = await get_user_id(message.from_user.id)
-    if your_id:
-        await message.answer(f"🆔 Ваш текущий ID: {your_id}")
-    else:
+    programs = await get_tracked_programs(message.from_user.id)
+    precomputed = await get_user_positions(message.from_user.id)
+    await message.answer(format_my_id(your_id, programs, precomputed))
+
+
+# Обработчик команды /history
+@dp.message(Command("history"))
+async def cmd_history(message: types.Message):
+    your_id = await get_user_id(message.from_user.id)
+    if not your_id:
         await message.answer("❌ ID не установлен. Используйте /set_id <ваш_id> для установки.")
+        return
+
+    blocks = []
+    for program in await get_tracked_programs(message.from_user.id):
+        timeline = await get_applicant_timeline(program, your_id)
+        if not timeline:
+            blocks.append(f"{format_program(program)}ℹ️ История позиции пока пуста")
+            continue
+
+        lines = []
+        for timestamp, position, contract, paid, unpaid in timeline:
+            moment = str(timestamp)[:16]
+            if position is None:
+                lines.append(f"{moment}: нет в списке")
+                continue
+            line = f"{moment}: {position}"
+            if contract:
+                line += f", договор {contract}"
+                if paid:
+                    line += f", оплачен {paid}"
+                elif unpaid:
+                    line += f", не оплачен {unpaid}"
+            lines.append(line)
+        blocks.append(format_program(program) + "\n".join(lines))
+
+    await message.answer(f"📉 История позиции {your_id}:\n\n" + "\n\n".join(blocks))
 
 
 # Обработчик проверки рейтинга
 @dp.message(F.text == "📊 Проверить рейтинг")
 async def check_rating(message: types.Message):
-    await message.answer("🔄 Парсинг данных, подождите...")
+    programs = await get_tracked_programs(message.from_user.id)
+    caches = [snapshot_caches[program] for program in programs]
+
+    # Ждать приходится, только если снимка еще нет: устаревший отдается сразу и обновляется в фоне
+    if any(cache.peek() is None for cache in caches):
+        await message.answer("🔄 Парсинг данных, подождите...")
 
     user_your_id = await get_user_id(message.from_user.id)
 
-    parser = ITMOParser()
-    data = parser.parse_rating(user_your_id)
-
-    if data:
-        # Формируем текст о позиции пользователя
-        if user_your_id:
-            if data['your_position']:
-                your_pos_text = f"🎯 Ваша позиция: {data['your_position']}"
-                if data['your_contract_position']:
-                    your_pos_text += f"\n💼 Позиция среди договоров: {data['your_contract_position']}"
-                    if data['your_paid_position']:
-                        your_pos_text += f"\n💰 Позиция среди оплаченных: {data['your_paid_position']}"
-                    elif data['your_unpaid_position']:
-                        your_pos_text += f"\n⏳ Позиция среди неоплаченных: {data['your_unpaid_position']}"
-                else:
-                    your_pos_text += f"\n💼 У вас нет договора"
-            else:
-                your_pos_text = f"❌ Ваш ID ({user_your_id}) не найден в списке"
-        else:
-            your_pos_text = "ℹ️ Установите свой ID в настройках для отслеживания позиции"
-
-        result_text = (
-            f"📈 **Статистика рейтинга ИТМО**\n\n"
-            f"👥 Всего человек в списке: {data['total_people']}\n"
-            f"📝 Человек с договорами: {data['contract_count']}\n"
-            f"💰 Договоры оплачены: {data['contract_paid_count']}\n"
-            f"⏳ Договоры не оплачены: {data['contract_unpaid_count']}\n\n"
-            f"{your_pos_text}\n\n"
-            f"🕐 Обновлено: {data['timestamp']} (МСК)"
-        )
+    # Снимки всех программ пользователя загружаются параллельно
+    snapshots = await asyncio.gather(*(cache.get() for cache in caches))
 
-        # Сохраняем данные
-        await save_rating_data(data)
+    # Позиции, посчитанные при сохранении снимка: чтение по первичному ключу
+    precomputed = await get_user_positions(message.from_user.id)
 
-        await message.answer(result_text, parse_mode='Markdown')
-    else:
+    if not any(snapshots):
         await message.answer("❌ Ошибка при парсинге данных. Попробуйте позже.")
+        return
+
+    blocks = []
+    for program, snapshot in zip(programs, snapshots):
+        if not snapshot:
+            blocks.append(f"{format_program(program)}❌ Ошибка при парсинге данных. Попробуйте позже.")
+            continue
+
+        your_pos_text = format_position(snapshot, user_your_id, precomputed.get(program))
+        blocks.append(
+            f"{format_program(program)}"
+            f"👥 Всего человек в списке: {snapshot.total_people}\n"
+            f"📝 Человек с договорами: {snapshot.contract_count}\n"
+            f"💰 Договоры оплачены: {snapshot.contract_paid_count}\n"
+            f"⏳ Договоры не оплачены: {snapshot.contract_unpaid_count}\n\n"
+            f"{your_pos_text}\n\n"
+            f"🕐 Обновлено: {snapshot.timestamp} (МСК)"
+            f"{format_staleness(program)}"
+        )
+
+    result_text = "📈 **Статистика рейтинга ИТМО**\n\n" + "\n\n".join(blocks)
+    throttle.remember(message.from_user.id, message.text, result_text, 'Markdown')
+    await message.answer(result_text, parse_mode='Markdown')
 
 
 # Обработчик настроек
@@ -231,10 +488,35 @@ async def callback_set_id(callback: types.CallbackQuery):
 async def callback_show_id(callback: types.CallbackQuery):
     await callback.answer()
     your_id = await get_user_id(callback.from_user.id)
-    if your_id:
-        await callback.message.answer(f"🆔 Ваш текущий ID: {your_id}")
-    else:
-        await callback.message.answer("❌ ID не установлен. Используйте /set_id <ваш_id> для установки.")
+    programs = await get_tracked_programs(callback.from_user.id)
+    precomputed = await get_user_positions(callback.from_user.id)
+    await callback.message.answer(format_my_id(your_id, programs, precomputed))
+
+
+@dp.callback_query(F.data == "programs")
+async def callback_programs(callback: types.CallbackQuery):
+    await callback.answer()
+    programs = await get_tracked_programs(callback.from_user.id)
+    await callback.message.answer(
+        "🎓 Выберите программы для отслеживания:",
+        reply_markup=get_programs_keyboard(programs)
+    )
+
+
+@dp.callback_query(F.data.startswith("program:"))
+async def callback_toggle_program(callback: types.CallbackQuery):
+    program = callback.data.split(":", 1)[1]
+    if program not in PROGRAMS:
+        await callback.answer("❌ Программа больше не отслеживается", show_alert=True)
+        return
+
+    enabled, programs = await toggle_user_program(callback.from_user.id, program, PROGRAMS)
+    if enabled is None:
+        await callback.answer("⚠️ Нельзя убрать последнюю программу: сначала добавьте другую", show_alert=True)
+        return
+
+    await callback.answer("✅ Программа добавлена" if enabled else "✅ Программа убрана")
+    await callback.message.edit_reply_markup(reply_markup=get_programs_keyboard(programs))
 
 
 @dp.callback_query(F.data == "admin_users")
@@ -250,7 +532,8 @@ async def callback_admin_users(callback: types.CallbackQuery):
         f"👥 **Статистика пользователей**\n\n"
         f"Всего пользователей: {stats['total_users']}\n"
         f"Подписчиков: {stats['total_subscribers']}\n"
-        f"Всего сообщений: {stats['total_messages']}\n\n"
+        f"Всего сообщений: {stats['total_messages']}\n"
+        f"Заблокировали бота: {stats['total_blocked']}\n\n"
         f"**Топ активных пользователей:**\n"
     )
 
@@ -259,6 +542,16 @@ async def callback_admin_users(callback: types.CallbackQuery):
         name = first_name or username or f"ID:{user_id}"
         text += f"{i}. {name} - {msg_count} сообщений\n"
 
+    text += (
+        f"\n⏳ **Ограничение запросов:**\n"
+        f"Отклонено по лимиту пользователя: {throttle.hits['user']}\n"
+        f"Отклонено по общему лимиту: {throttle.hits['global']}\n"
+        f"Повторно отправлено последних ответов: {throttle.served_cached}\n"
+        f"Отслеживается пользователей: {len(throttle.users)} (вытеснено {throttle.evicted})\n"
+    )
+    for user_id, hits in throttle.top():
+        text += f"ID:{user_id} - отклонено {hits}\n"
+
     await callback.message.answer(text, parse_mode='Markdown')
 
 
@@ -271,12 +564,27 @@ async def callback_admin_rating(callback: types.CallbackQuery):
     await callback.answer()
     stats = await get_rating_stats()
 
-    text = "📈 **Последние записи рейтинга:**\n\n"
+    # Аналитика берется из окон в памяти, история не сканируется
+    text = "📊 **Темп роста договоров:**\n\n"
+    for program in PROGRAMS:
+        text += f"{format_program(program)}{format_velocity(program)}\n\n"
+
+    if len(PROGRAMS) > 1:
+        ranking = sorted(PROGRAMS, key=lambda program: velocity.get(program).rates()['24ч'][0], reverse=True)
+        text += "🏁 **Сравнение за 24ч:**\n"
+        for i, program in enumerate(ranking, 1):
+            contracts_delta, paid_delta, _, _ = velocity.get(program).rates()['24ч']
+            text += f"{i}. {program}: договоры {contracts_delta:+d}, оплачено {paid_delta:+d}\n"
+        text += "\n"
+
+    text += "📈 **Последние записи рейтинга:**\n\n"
 
     for record in stats:
-        timestamp, total, contracts, paid, unpaid = record
+        timestamp, program, total, contracts, paid, unpaid, last_seen = record
         text += (
             f"🕐 {timestamp}\n"
+            f"👁️ Последняя проверка: {str(last_seen or timestamp)[:19]}\n"
+            f"{format_program(program)}"
             f"Всего: {total}, Договоры: {contracts}\n"
             f"Оплачено: {paid}, Не оплачено: {unpaid}\n\n"
         )
@@ -284,6 +592,101 @@ async def callback_admin_rating(callback: types.CallbackQuery):
     await callback.message.answer(text, parse_mode='Markdown')
 
 
+# Выгрузка истории рейтинга в сжатых CSV (только для админа)
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав для выгрузки истории.")
+        return
+
+    args = message.text.split()[1:]
+    program = args[0] if args else None
+    if program and program not in PROGRAMS:
+        await message.answer(f"❌ Неизвестная программа: {program}")
+        return
+
+    # Модуль нужен только для выгрузки, при запуске бота он не загружается
+    from history_io import export_history
+
+    status = await message.answer("⏳ Выгружаю историю...")
+    with tempfile.TemporaryDirectory() as directory:
+        files = await export_history(directory, program)
+        for path, rows in files:
+            await message.answer_document(FSInputFile(path), caption=f"📦 {rows} строк")
+    await status.edit_text("✅ История выгружена")
+
+
+# Прогноз достижения числа договоров (только для админа)
+@dp.message(Command("forecast"))
+async def cmd_forecast(message: types.Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав доступа к аналитике.")
+        return
+
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer("Использование: /forecast <число> [paid]\n"
+                             "Пример: /forecast 300 - когда договоров станет 300\n"
+                             "/forecast 200 paid - когда оплаченных станет 200")
+        return
+
+    target = int(args[0])
+    paid = len(args) > 1 and args[1] == 'paid'
+    what = "оплаченных договоров" if paid else "договоров"
+
+    blocks = []
+    for program in PROGRAMS:
+        seconds, window, rate = velocity.get(program).forecast(target, paid)
+        if seconds == 0:
+            line = f"✅ {target} {what} уже есть"
+        elif seconds is None:
+            line = "📉 Роста нет - прогноз невозможен"
+        else:
+            eta = format_moscow_time(datetime.now(MOSCOW_TZ) + timedelta(seconds=seconds))
+            line = (f"⏱️ {target} {what} через ~{format_duration(seconds)} ({eta} МСК)\n"
+                    f"Темп за {window}: {rate:.1f}/ч")
+        blocks.append(format_program(program) + line)
+
+    await message.answer("🔮 Прогноз:\n\n" + "\n\n".join(blocks))
+
+
+@dp.callback_query(F.data == "admin_daily")
+async def callback_admin_daily(callback: types.CallbackQuery):
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+
+    await callback.answer()
+
+    blocks = []
+    for program in PROGRAMS:
+        lines = []
+        for bucket, samples, total, contracts, paid, unpaid, low, high in await get_rating_rollup(program):
+            day = datetime.fromtimestamp(bucket, MOSCOW_TZ).strftime('%Y-%m-%d')
+            spread = f" ({low}–{high})" if low != high else ""
+            lines.append(f"{day}: договоры {contracts}{spread}, оплачено {paid}, записей {samples}")
+        blocks.append(format_program(program) + ("\n".join(lines) or "ℹ️ Истории пока нет"))
+
+    await callback.message.answer("📅 Рейтинг по дням (МСК):\n\n" + "\n\n".join(blocks))
+
+
+@dp.callback_query(F.data == "admin_schedule")
+async def callback_admin_schedule(callback: types.CallbackQuery):
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+
+    await callback.answer()
+    if not lease.is_leader:
+        await callback.message.answer(f"⏰ Парсинг выполняет другой процесс: {lease.holder() or '—'}")
+        return
+    breakers = {get_breaker(url).name: get_breaker(url) for url in PROGRAMS.values()}
+    await callback.message.answer(
+        f"⏰ Расписание парсинга (МСК):\n\n{scheduler.describe()}\n\n"
+        + "\n".join(breaker.describe() for breaker in breakers.values())
+    )
+
+
 @dp.callback_query(F.data == "admin_broadcast")
 async def callback_admin_broadcast(callback: types.CallbackQuery):
     if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
@@ -310,152 +713,262 @@ async def cmd_broadcast(message: types.Message):
         return
 
     subscribers = await get_all_subscribers()
-    sent = 0
+    batch = f"broadcast:{int(time.time())}:{message.message_id}"
+    total = await enqueue_messages(
+        batch,
+        [(user_id, f"📢 **Сообщение от администратора:**\n\n{text}", 'Markdown') for user_id in subscribers]
+    )
+    outbox.wake()
+    status = await message.answer(f"📢 Рассылка: 0/{total}")
 
-    for user_id in subscribers:
+    # Ход рассылки читается из очереди: доставка переживает перезапуск бота
+    started = last_progress = time.monotonic()
+    done = 0
+    while True:
+        await asyncio.sleep(5)
+        progress = await get_outbox_progress(batch)
+        now = time.monotonic()
+        if total - progress['pending'] != done:
+            done = total - progress['pending']
+            last_progress = now
+        elapsed = now - started
+        summary = (f"{done}/{total}, отправлено {progress['sent']}, ошибок {progress['failed']}, "
+                   f"заблокировали {progress['dead']}, {elapsed:.0f} с ({done / elapsed:.1f} сообщ/с)")
+        if not progress['pending']:
+            break
+
+        # Очередь разбирает лидер: без него (или пока сообщения ждут повтора) ждать бесполезно
+        if now - last_progress > OUTBOX_STALL_TIMEOUT:
+            await message.answer(f"⚠️ Рассылка не продвигается {now - last_progress:.0f} с, "
+                                 f"осталось {progress['pending']} сообщений. Они будут доставлены "
+                                 f"в фоне, как только очередь разберет лидер (см. «⏰ Расписание парсинга» в /admin).\n{summary}")
+            return
         try:
-            await bot.send_message(user_id, f"📢 **Сообщение от администратора:**\n\n{text}", parse_mode='Markdown')
-            sent += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            print(f"Ошибка отправки пользователю {user_id}: {e}")
+            await status.edit_text(f"📢 Рассылка: {summary}")
+        except TelegramBadRequest:
+            # Текст не изменился с прошлого обновления
+            pass
+
+    await message.answer(f"✅ Рассылка завершена. Отправлено: {progress['sent']}/{total}\n{summary}")
+
+
+def format_position_change(your_id, old, new):
+    """Персональная часть уведомления: как изменились позиции абитуриента"""
+    if not your_id:
+        return ""
+
+    if old is None and new is None:
+        return ""
+    if new is None:
+        return f"❌ Ваш ID ({your_id}) пропал из списка"
+    if old is None:
+        return f"🆕 Ваш ID ({your_id}) появился в списке: позиция {new.overall}"
+
+    def arrow(before, after):
+        return f"{before or '—'} → {after or '—'}"
 
-    await message.answer(f"✅ Рассылка завершена. Отправлено: {sent}/{len(subscribers)}")
+    lines = []
+    if old.overall != new.overall:
+        lines.append(f"🎯 Ваша позиция: {arrow(old.overall, new.overall)}")
+    if old.contract != new.contract:
+        lines.append(f"💼 Среди договоров: {arrow(old.contract, new.contract)}")
+    if old.paid != new.paid:
+        lines.append(f"💰 Среди оплаченных: {arrow(old.paid, new.paid)}")
+    if old.unpaid != new.unpaid:
+        lines.append(f"⏳ Среди неоплаченных: {arrow(old.unpaid, new.unpaid)}")
+    return "\n".join(lines) or f"🎯 Ваша позиция не изменилась: {new.overall}"
 
 
 # Функция уведомления пользователей
-async def notify_users(old_data, new_data):
-    """Уведомить всех подписчиков об изменении"""
+async def notify_users(diff):
+    """Уведомить подписчиков программы об изменениях с персональными позициями"""
     try:
-        users = await get_all_subscribers()
+        old, new = diff.old, diff.new
+        program = new.program
+        users = await get_program_subscribers(program)
         moscow_time = format_moscow_time()
 
         # Формируем сообщение об изменениях
         changes = []
-        if old_data.get('contract_count', 0) != new_data['contract_count']:
-            changes.append(f"Договоры: {old_data.get('contract_count', 0)} → {new_data['contract_count']}")
-        if old_data.get('contract_paid_count', 0) != new_data['contract_paid_count']:
-            changes.append(f"Оплачено: {old_data.get('contract_paid_count', 0)} → {new_data['contract_paid_count']}")
-        if old_data.get('contract_unpaid_count', 0) != new_data['contract_unpaid_count']:
-            changes.append(
-                f"Не оплачено: {old_data.get('contract_unpaid_count', 0)} → {new_data['contract_unpaid_count']}")
-
-        if not changes:
-            return
+        if old.contract_count != new.contract_count:
+            changes.append(f"Договоры: {old.contract_count} → {new.contract_count}")
+        if old.contract_paid_count != new.contract_paid_count:
+            changes.append(f"Оплачено: {old.contract_paid_count} → {new.contract_paid_count}")
+        if old.contract_unpaid_count != new.contract_unpaid_count:
+            changes.append(f"Не оплачено: {old.contract_unpaid_count} → {new.contract_unpaid_count}")
+        if diff.entered or diff.left:
+            changes.append(f"В списке: +{len(diff.entered)} / −{len(diff.left)}")
+        if diff.gained_contract or diff.lost_contract:
+            changes.append(f"Новые договоры: +{len(diff.gained_contract)} / −{len(diff.lost_contract)}")
+        if diff.became_paid:
+            changes.append(f"Стали оплаченными: {len(diff.became_paid)}")
 
         message_text = (
                 f"🚨 **!!!ОБНОВЛЕНИЕ РЕЙТИНГА!!!**\n\n"
+                f"{format_program(program)}"
                 f"📊 Изменения:\n" + "\n".join(changes) + "\n\n"
                                                          f"📈 Текущая статистика:\n"
-                                                         f"👥 Всего людей: {new_data['total_people']}\n"
-                                                         f"📝 Договоры: {new_data['contract_count']}\n"
-                                                         f"💰 Оплачено: {new_data['contract_paid_count']}\n"
-                                                         f"⏳ Не оплачено: {new_data['contract_unpaid_count']}\n\n"
-                                                         f"🕐 {moscow_time} (МСК)"
+                                                         f"👥 Всего людей: {new.total_people}\n"
+                                                         f"📝 Договоры: {new.contract_count}\n"
+                                                         f"💰 Оплачено: {new.contract_paid_count}\n"
+                                                         f"⏳ Не оплачено: {new.contract_unpaid_count}\n\n"
         )
 
-        successful_sends = 0
-        for user_id in users:
-            try:
-                await bot.send_message(user_id, message_text, parse_mode='Markdown')
-                successful_sends += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                print(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+        messages = []
+        for user_id, your_id, precomputed in users:
+            # Позиции до и после посчитаны при сохранении снимка; если строка устарела
+            # (ID сменился позже), они берутся за O(1) из индексов обоих снимков
+            if (precomputed and precomputed.previous_known and precomputed.your_id == your_id
+                    and precomputed.fingerprint == new.fingerprint):
+                before, after = precomputed.previous, precomputed.position
+            else:
+                before, after = old.position_of(your_id), new.position_of(your_id)
+            personal = format_position_change(your_id, before, after)
+            text = message_text + (f"{personal}\n\n" if personal else "") + f"🕐 {moscow_time} (МСК)"
+            messages.append((user_id, text, 'Markdown'))
 
-        print(f"✅ Уведомления отправлены {successful_sends}/{len(users)} пользователям")
+        # Сообщения сохраняются в очередь, отправит их OutboxWorker
+        await enqueue_messages(f"notify:{program}:{new.timestamp}", messages)
+        outbox.wake()
+        print(f"✅ Уведомления {program} поставлены в очередь: {len(messages)}")
 
     except Exception as e:
         print(f"❌ Ошибка в notify_users: {e}")
 
 
-# Функция парсинга по расписанию
-def scheduled_parsing():
-    """Функция для выполнения парсинга по расписанию"""
-    try:
-        parser = ITMOParser()
+async def refresh_program(program):
+    """Обновить снимок программы, вернуть True, если рейтинг изменился (уведомления рассылаются при загрузке)"""
+    snapshot = await snapshot_caches[program].get(force=True)
+    moscow_time = format_moscow_time()
 
-        # Получаем последние данные
-        old_count = asyncio.run(get_last_contract_count())
+    if not snapshot:
+        print(f"❌ Ошибка при парсинге {program} в {moscow_time}")
+        return False
 
-        # Парсим новые данные
-        data = parser.parse_rating()
+    status = "без изменений" if snapshot.not_modified else f"договоров: {snapshot.contract_count}"
+    print(f"✅ Парсинг выполнен: {program}, {moscow_time}, {status}")
+    return not snapshot.not_modified
 
-        if data:
-            # Сохраняем данные
-            asyncio.run(save_rating_data(data))
 
-            # Если количество изменилось, отправляем уведомления
-            if old_count is not None and old_count != data['contract_count']:
-                moscow_time = format_moscow_time()
-                print(f"🔄 Изменение обнаружено: {old_count} -> {data['contract_count']} в {moscow_time}")
+async def refresh_all_programs():
+    """Обновить все программы параллельно (с ограничением запросов к сайту), вернуть True при изменениях"""
+    results = await asyncio.gather(*(refresh_program(program) for program in PROGRAMS))
+    return any(results)
 
-                # Запускаем уведомления в основном event loop
-                if main_loop and not main_loop.is_closed():
-                    old_data = {'contract_count': old_count}
-                    asyncio.run_coroutine_threadsafe(
-                        notify_users(old_data, data),
-                        main_loop
-                    )
 
-            moscow_time = format_moscow_time()
-            print(f"✅ Парсинг выполнен: {moscow_time}, договоров: {data['contract_count']}")
-        else:
-            moscow_time = format_moscow_time()
-            print(f"❌ Ошибка при парсинге в {moscow_time}")
+# Парсинг по расписанию в основном event loop: чаще в пиковые окна, реже, пока ничего не меняется
+scheduler = AdaptiveScheduler(refresh_all_programs)
+
+
+async def run_leader_duties():
+    """Парсинг, уведомления и обслуживание базы: выполняются только в процессе-лидере"""
+    # Пока процесс не был лидером, снимки мог сохранять другой процесс
+    reset_snapshot_state()
+    for parser in rating_parsers.values():
+        parser.reset()
+    await velocity.rebuild(PROGRAMS, get_rating_series)
 
+    # Доставка сообщений из очереди (неотправленные до перезапуска уйдут сразу)
+    # и прореживание старой истории рейтинга
+    tasks = [asyncio.create_task(outbox.run()), asyncio.create_task(run_retention())]
+    try:
+        print("🔄 Выполняем первоначальный парсинг...")
+        scheduler.schedule_next(await refresh_all_programs())
+        print(f"📅 Планировщик запущен, следующий парсинг в {format_moscow_time(scheduler.next_run)}")
+        await scheduler.run()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def restore_snapshot(program):
+    """Заполнить кэш программы последним сохраненным снимком: пользователи получают ответ до первого парсинга.
+
+    Ошибка не мешает запуску: кэш программы остается пустым до первой загрузки.
+    """
+    try:
+        snapshot = await load_last_snapshot(program)
+        if snapshot:
+            saved = MOSCOW_TZ.localize(datetime.strptime(snapshot.timestamp, '%Y-%m-%d %H:%M:%S'))
+            snapshot_caches[program].prime(snapshot, (get_moscow_time() - saved).total_seconds())
     except Exception as e:
-        moscow_time = format_moscow_time()
-        print(f"❌ Ошибка в scheduled_parsing в {moscow_time}: {e}")
+        print(f"❌ Ошибка восстановления снимка {program}: {e}")
 
 
-# Функция для запуска планировщика в отдельном потоке
-def run_scheduler():
-    import schedule
+async def restore_velocity():
+    """Восстановить окна аналитики за 7 дней; ошибка не мешает запуску бота"""
+    try:
+        await velocity.rebuild(PROGRAMS, get_rating_series)
+    except Exception as e:
+        print(f"❌ Ошибка восстановления аналитики: {e}")
 
-    # Настраиваем расписание
-    schedule.every(2).hours.do(scheduled_parsing)
 
-    moscow_time = format_moscow_time()
-    print(f"📅 Планировщик запущен (каждые 2 часа) в {moscow_time}")
+def mark_ready():
+    """Записать, сколько секунд прошло от запуска до готовности принимать обновления"""
+    elapsed = time.monotonic() - STARTED_AT
+    metrics.STARTUP_SECONDS.set(round(elapsed, 3))
+    if elapsed > STARTUP_BUDGET:
+        print(f"⚠️ Запуск занял {elapsed:.2f} с, больше бюджета {STARTUP_BUDGET:.1f} с")
+    else:
+        print(f"⚡ Бот готов за {elapsed:.2f} с (бюджет {STARTUP_BUDGET:.1f} с)")
 
-    while True:
-        try:
-            schedule.run_pending()
-            time.sleep(60)  # Проверяем каждую минуту
-        except Exception as e:
-            moscow_time = format_moscow_time()
-            print(f"❌ Ошибка в планировщике в {moscow_time}: {e}")
-            time.sleep(60)
+
+# Готовность отмечается, когда начинается polling или запускается сервер webhook
+dp.startup.register(mark_ready)
 
 
 # Основная функция
 async def main():
-    global main_loop
-    main_loop = asyncio.get_running_loop()
+    print_summary()
+
+    # После работы через webhook getUpdates недоступен, пока webhook не удален.
+    # Запрос к Telegram идет параллельно с чтением базы
+    polling = ROLE != 'worker' and BOT_MODE == 'polling'
+    drop_webhook = asyncio.create_task(bot.delete_webhook()) if polling else None
 
     # Инициализируем базу данных
     await init_database()
 
+    # Последние снимки всех программ и окна аналитики (за 7 дней) восстанавливаются
+    # из базы одновременно, первый парсинг идет в фоне и не задерживает запуск
+    await asyncio.gather(*(restore_snapshot(program) for program in PROGRAMS), restore_velocity())
+
     moscow_time = format_moscow_time()
-    print(f"🚀 Бот запущен в {moscow_time}!")
+    print(f"🚀 Бот запущен в {moscow_time}! Роль: {ROLE}")
 
-    # Запускаем планировщик в отдельном потоке
-    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-    scheduler_thread.start()
+    # Фоновая запись активности пользователей
+    activity_task = asyncio.create_task(run_activity_flusher())
 
-    # Выполняем первоначальный парсинг
-    print("🔄 Выполняем первоначальный парсинг...")
-    scheduled_parsing()
+    # Метрики Prometheus и проверка работоспособности
+    lag_task = asyncio.create_task(metrics.monitor_loop_lag())
+    metrics_runner = await metrics.start_server(
+        PROGRAMS,
+        polling=polling,
+        scraping=lambda: lease.is_leader
+    )
+
+    # Парсинг и рассылка: процессы с ролью all и worker соревнуются за лидерство
+    leader_task = asyncio.create_task(lease.run(run_leader_duties)) if ROLE != 'bot' else None
 
     # Запускаем бота с обработкой ошибок
+    webhook_runner = None
     try:
-        await dp.start_polling(
-            bot,
-            polling_timeout=20,
-            request_timeout=15,
-            retry_after=3
-        )
+        if ROLE == 'worker':
+            mark_ready()
+            await asyncio.Event().wait()
+        elif BOT_MODE == 'webhook':
+            from webhook import start_webhook
+            webhook_runner = await start_webhook(dp, bot)
+            await asyncio.Event().wait()
+        else:
+            await drop_webhook
+            await dp.start_polling(
+                bot,
+                polling_timeout=20,
+                request_timeout=15,
+                retry_after=3,
+                tasks_concurrency_limit=MAX_INFLIGHT_UPDATES
+            )
     except KeyboardInterrupt:
         moscow_time = format_moscow_time()
         print(f"🛑 Бот остановлен пользователем в {moscow_time}")
@@ -463,6 +976,20 @@ async def main():
         moscow_time = format_moscow_time()
         print(f"❌ Критическая ошибка в {moscow_time}: {e}")
     finally:
+        if leader_task:
+            leader_task.cancel()
+            try:
+                await leader_task
+            except asyncio.CancelledError:
+                pass
+        activity_task.cancel()
+        lag_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        await close_session()
+        await close_database()
         await bot.session.close()
 
 
@@ -0,0 +1,288 @@
+"""Метрики в формате Prometheus и проверка работоспособности.
+
+Встроенный HTTP сервер отдает /metrics (текстовый формат Prometheus) и /healthz:
+503, если давно не было успешного парсинга, long polling не получает ответов
+или event loop заблокирован.
+"""
+import asyncio
+import functools
+import json
+import time
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT, HEALTH_SCRAPE_AGE, HEALTH_POLL_AGE, HEALTH_LOOP_LAG
+
+# Стандартные границы гистограмм Prometheus, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Все метрики процесса в порядке объявления
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labels}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self._values.items()):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}']
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Значение, которое может расти и уменьшаться"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (обычно длительностей в секундах)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма значений
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = state[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+        state[1] += value
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def time(self, **labels):
+        """Контекстный менеджер, измеряющий длительность блока"""
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """Декоратор корутины: длительность каждого вызова с меткой operation = имя функции"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(operation=func.__name__, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = _format_labels(self.labels, key, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labels, key)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+# Парсинг
+FETCH_SECONDS = Histogram('itmo_fetch_seconds', 'Длительность запроса страницы рейтинга', ['program'],
+                          buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+FETCH_TOTAL = Counter('itmo_fetch_total', 'Запросы страницы рейтинга по результату', ['program', 'result'])
+PARSE_SECONDS = Histogram('itmo_parse_seconds', 'Длительность разбора страницы рейтинга', ['program'],
+                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+BREAKER_STATE = Gauge('itmo_breaker_state', 'Состояние предохранителя: 0 - замкнут, 1 - проба, 2 - разомкнут',
+                      ['host'])
+BREAKER_TRANSITIONS = Counter('itmo_breaker_transitions_total', 'Переходы предохранителя по новому состоянию',
+                              ['host', 'state'])
+SCRAPE_AGE = Gauge('itmo_last_scrape_age_seconds', 'Сколько секунд назад был последний успешный парсинг',
+                   ['program'])
+
+# База данных
+DB_SECONDS = Histogram('itmo_db_seconds', 'Длительность операций с базой', ['operation'],
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+# Telegram
+HANDLER_SECONDS = Histogram('itmo_handler_seconds', 'Длительность обработчиков aiogram', ['handler'])
+HANDLER_ERRORS = Counter('itmo_handler_errors_total', 'Исключения в обработчиках aiogram', ['handler'])
+MESSAGES_TOTAL = Counter('itmo_messages_total', 'Отправленные сообщения по результату', ['result'])
+THROTTLED_TOTAL = Counter('itmo_throttled_total', 'Запросы, отклоненные ограничением частоты', ['scope'])
+POLL_AGE = Gauge('itmo_last_poll_age_seconds', 'Сколько секунд назад long polling получил ответ Telegram')
+
+# Процесс
+STARTUP_SECONDS = Gauge('itmo_startup_seconds', 'Время от запуска процесса до готовности принимать обновления')
+LOOP_LAG = Gauge('itmo_event_loop_lag_seconds', 'Последняя задержка event loop')
+LOOP_LAG_SECONDS = Histogram('itmo_event_loop_lag_histogram_seconds', 'Задержки event loop',
+                             buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+# Время (monotonic) последнего успешного парсинга по программам и ответа long polling
+_started = time.monotonic()
+_last_scrape = {}
+_last_poll = None
+
+
+def record_scrape(program):
+    """Отметить успешный парсинг программы (в том числе без изменений)"""
+    _last_scrape[program] = time.monotonic()
+
+
+def record_poll():
+    """Отметить ответ Telegram на getUpdates"""
+    global _last_poll
+    _last_poll = time.monotonic()
+
+
+def scrape_ages(programs):
+    """Возраст последнего успешного парсинга по программам (до первого - время работы процесса)"""
+    now = time.monotonic()
+    return {program: now - _last_scrape.get(program, _started) for program in programs}
+
+
+def poll_age():
+    """Сколько секунд назад был ответ на getUpdates (None, если long polling не используется)"""
+    return None if _last_poll is None else time.monotonic() - _last_poll
+
+
+def render(programs):
+    """Все метрики в текстовом формате Prometheus"""
+    for program, age in scrape_ages(programs).items():
+        SCRAPE_AGE.set(round(age, 3), program=program)
+    age = poll_age()
+    if age is not None:
+        POLL_AGE.set(round(age, 3))
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def health(programs, polling=True, scraping=True):
+    """Проверка работоспособности: (здоров ли процесс, подробности).
+
+    Возраст парсинга проверяется только у процесса, который парсит (scraping).
+    """
+    problems = []
+    ages = scrape_ages(programs)
+    for program, age in ages.items():
+        if scraping and age > HEALTH_SCRAPE_AGE:
+            problems.append(f"нет успешного парсинга {program} {age:.0f} с")
+
+    polled = poll_age()
+    if polling:
+        # До первого ответа getUpdates отсчитываем от запуска процесса
+        if polled is None:
+            polled = time.monotonic() - _started
+        if polled > HEALTH_POLL_AGE:
+            problems.append(f"long polling не получает ответов {polled:.0f} с")
+
+    lag = LOOP_LAG.value() or 0.0
+    if lag > HEALTH_LOOP_LAG:
+        problems.append(f"event loop заблокирован на {lag:.1f} с")
+
+    details = {
+        'status': 'ok' if not problems else 'fail',
+        'problems': problems,
+        'scrape_age': {program: round(age, 1) for program, age in ages.items()} if scraping else None,
+        'poll_age': round(polled, 1) if polling else None,
+        'loop_lag': round(lag, 4)
+    }
+    return not problems, details
+
+
+async def monitor_loop_lag(interval=1.0):
+    """Измерять, насколько позже запланированного просыпается event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        LOOP_LAG.set(round(lag, 6))
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+async def start_server(programs, polling=True, scraping=lambda: True, host=METRICS_HOST, port=METRICS_PORT):
+    """Запустить HTTP сервер метрик, вернуть runner для остановки (None, если сервер выключен).
+
+    scraping - функция без аргументов: парсит ли процесс сейчас (лидер ли он).
+    """
+    if not port:
+        return None
+
+    async def metrics_handler(request):
+        return web.Response(text=render(programs), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def health_handler(request):
+        healthy, details = health(programs, polling, scraping())
+        return web.Response(text=json.dumps(details, ensure_ascii=False), content_type='application/json',
+                            status=200 if healthy else 503)
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/healthz', health_handler)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"📈 Метрики: http://{host}:{port}/metrics, проверка: /healthz")
+    return runner
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from config import BROADCAST_WORKERS, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL
+from database import fetch_outbox, complete_outbox, purge_outbox
+from broadcast import BroadcastStats, SENT, BLOCKED, REJECTED
+
+# Как часто удалять из очереди старые обработанные сообщения, сек
+PURGE_INTERVAL = 3600
+
+
+class OutboxWorker:
+    """Доставка сообщений из таблицы outbox пачками через общий Broadcaster.
+
+    Итоги пишутся в базу после каждой пачки, поэтому после перезапуска доставка
+    продолжается с первого неотправленного сообщения (в худшем случае сообщения
+    последней незаписанной пачки уйдут повторно).
+    """
+
+    def __init__(self, broadcaster, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 workers=BROADCAST_WORKERS):
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._slots = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+        self._last_purge = 0.0
+
+    def wake(self):
+        """Сообщить, что в очереди появились новые сообщения"""
+        self._wakeup.set()
+
+    async def _deliver(self, row, stats):
+        message_id, user_id, text, parse_mode, attempts = row
+        async with self._slots:
+            try:
+                return await self.broadcaster.send(user_id, text, stats, parse_mode=parse_mode)
+            except Exception as e:
+                print(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+                return None
+
+    async def deliver_batch(self):
+        """Отправить одну пачку из очереди, вернуть ее статистику или None, если очередь пуста"""
+        rows = await fetch_outbox(self.batch_size)
+        if not rows:
+            return None
+
+        stats = BroadcastStats(total=len(rows))
+        results = await asyncio.gather(*(self._deliver(row, stats) for row in rows))
+        stats.finished = time.monotonic()
+        self.broadcaster.prune_chat_intervals()
+
+        sent_ids, failed, rejected_ids, blocked_user_ids = [], [], [], []
+        for (message_id, user_id, _, _, attempts), result in zip(rows, results):
+            if result == SENT:
+                sent_ids.append(message_id)
+                stats.sent += 1
+            elif result == BLOCKED:
+                blocked_user_ids.append(user_id)
+                stats.blocked.append(user_id)
+            elif result == REJECTED:
+                rejected_ids.append(message_id)
+                stats.failed += 1
+            else:
+                failed.append((message_id, attempts))
+                stats.failed += 1
+
+        await complete_outbox(sent_ids, failed, blocked_user_ids, rejected_ids)
+        if blocked_user_ids:
+            print(f"🚫 Недоступные пользователи отписаны: {len(set(blocked_user_ids))}")
+        return stats
+
+    async def run(self):
+        """Разбирать очередь, пока она не опустеет, затем ждать новых сообщений"""
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.deliver_batch():
+                    pass
+
+                if time.monotonic() - self._last_purge > PURGE_INTERVAL:
+                    self._last_purge = time.monotonic()
+                    await purge_outbox()
+            except Exception as e:
+                print(f"❌ Ошибка доставки из очереди: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -1,17 +1,124 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import dataclasses
+import hashlib
+import random
+import time
+import aiohttp
 from datetime import datetime
+from urllib.parse import urlparse
 import pytz
-from config import ITMO_URL, HEADERS
+from config import (ITMO_URL, HEADERS, FETCH_TIMEOUT, PARSER_BACKEND, HOST_CONCURRENCY, FETCH_DELAY,
+                    FETCH_RETRIES, FETCH_BACKOFF)
+from archive import archive_page
+from breaker import CircuitBreaker, CircuitOpenError
+from extractors import get_extractor
+from metrics import FETCH_SECONDS, FETCH_TOTAL, PARSE_SECONDS, record_scrape
+from snapshot import RatingSnapshot, fingerprint_rows
 
 # Московская временная зона
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
+# Общая для процесса сессия aiohttp: соединения с сайтом переиспользуются между запросами
+_session = None
+
+
+def get_session():
+    """Получить общую сессию aiohttp (создается при первом обращении)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300, keepalive_timeout=60)
+        )
+    return _session
+
+
+async def close_session():
+    """Закрыть общую сессию aiohttp при остановке бота"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class HostLimiter:
+    """Ограничение одновременных запросов к одному сайту с паузой между запросами"""
+
+    def __init__(self, concurrency=HOST_CONCURRENCY, delay=FETCH_DELAY):
+        self.delay = delay
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_start = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        start = max(loop.time(), self._next_start)
+        self._next_start = start + self.delay
+        await asyncio.sleep(start - loop.time())
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+
+
+# Ограничители по хостам: все программы одного сайта делят один ограничитель
+_host_limiters = {}
+
+
+def get_host_limiter(url):
+    """Получить ограничитель запросов для хоста из URL"""
+    host = urlparse(url).netloc
+    if host not in _host_limiters:
+        _host_limiters[host] = HostLimiter()
+    return _host_limiters[host]
+
+
+# Предохранители по хостам: недоступность сайта касается всех его программ
+_breakers = {}
+
+
+def get_breaker(url):
+    """Получить предохранитель для хоста из URL"""
+    host = urlparse(url).netloc
+    if host not in _breakers:
+        _breakers[host] = CircuitBreaker(host)
+    return _breakers[host]
+
+
+def is_retryable(error):
+    """Имеет ли смысл повторить запрос: сетевые ошибки, таймауты, 5xx и 429"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
 
 class ITMOParser:
-    def __init__(self):
-        self.url = ITMO_URL
+    def __init__(self, url=ITMO_URL, program=None):
+        self.url = url
+        self.program = program
         self.headers = HEADERS
+        # Бэкенд разбора (и lxml) загружается при первом разборе, а не при запуске
+        self._extract = None
+
+        # Валидаторы последнего ответа для условных запросов
+        self.etag = None
+        self.last_modified = None
+        self.last_snapshot = None
+        # Хэш тела последнего ответа: та же страница не разбирается повторно
+        self.body_hash = None
+
+    @property
+    def extract(self):
+        if self._extract is None:
+            self._extract = get_extractor(PARSER_BACKEND)
+        return self._extract
+
+    def reset(self):
+        """Забыть результаты прошлых загрузок (например, когда парсинг перешел к этому процессу)"""
+        self.etag = None
+        self.last_modified = None
+        self.last_snapshot = None
+        self.body_hash = None
 
     def get_moscow_time(self):
         """Получить текущее московское время"""
@@ -23,84 +130,105 @@ class ITMOParser:
             dt = self.get_moscow_time()
         return dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    def parse_rating(self, user_your_id=None):
-        """Парсинг рейтинга с учетом новых типов договоров"""
-        try:
-            response = requests.get(self.url, headers=self.headers, timeout=30)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Находим все элементы рейтинга
-            rating_items = soup.find_all('div', class_='RatingPage_table__item__qMY0F')
-
-            total_people = len(rating_items)
-            contract_count = 0
-            contract_paid_count = 0  # Зеленые элементы (оплачено)
-            contract_unpaid_count = 0  # Желтые элементы (не оплачено)
-
-            your_position = None
-            your_contract_position = None
-            your_paid_position = None
-            your_unpaid_position = None
-
-            contract_position_counter = 0
-            paid_position_counter = 0
-            unpaid_position_counter = 0
-
-            for i, item in enumerate(rating_items, 1):
-                # Извлекаем номер заявления
-                position_element = item.find('p', class_='RatingPage_table__position__uYWvi')
-                if position_element:
-                    span = position_element.find('span')
-                    if span:
-                        application_id = span.text.strip()
-
-                        # Проверяем наличие договора
-                        contract_text = item.get_text()
-                        has_contract = 'Договор: да' in contract_text
-
-                        if has_contract:
-                            contract_count += 1
-                            contract_position_counter += 1
-
-                            # Определяем тип договора по CSS классам
-                            is_paid = 'RatingPage_table__item_green__InEVk' in str(item)
-                            is_unpaid = 'RatingPage_table__item_yellow__lbs7n' in str(item)
-
-                            if is_paid:
-                                contract_paid_count += 1
-                                paid_position_counter += 1
-                            elif is_unpaid:
-                                contract_unpaid_count += 1
-                                unpaid_position_counter += 1
-
-                        # Проверяем пользовательский ID
-                        if user_your_id and application_id == user_your_id:
-                            your_position = i
-                            if has_contract:
-                                your_contract_position = contract_position_counter
-                                if 'RatingPage_table__item_green__InEVk' in str(item):
-                                    your_paid_position = paid_position_counter
-                                elif 'RatingPage_table__item_yellow__lbs7n' in str(item):
-                                    your_unpaid_position = unpaid_position_counter
-
-            # Используем московское время
-            moscow_time = self.format_moscow_time()
+    async def fetch_snapshot(self):
+        """Неблокирующая загрузка снимка рейтинга через общую сессию aiohttp.
 
-            return {
-                'total_people': total_people,
-                'contract_count': contract_count,
-                'contract_paid_count': contract_paid_count,
-                'contract_unpaid_count': contract_unpaid_count,
-                'your_position': your_position,
-                'your_contract_position': your_contract_position,
-                'your_paid_position': your_paid_position,
-                'your_unpaid_position': your_unpaid_position,
-                'timestamp': moscow_time
-            }
+        Отправляет условный запрос: если страница не изменилась (304) или пришло
+        то же тело, разбор пропускается. Если изменилась только разметка, а строки
+        рейтинга те же, снимок не строится. В этих случаях возвращается предыдущий
+        снимок с not_modified=True.
+        """
+        try:
+            response = await self._request_with_retries()
+            if response is None:
+                return self._unchanged()
+            content, etag, last_modified = response
+
+            body_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+            if body_hash == self.body_hash and self.last_snapshot is not None:
+                return self._unchanged()
+
+            # Новая версия страницы сохраняется в архив до разбора: ее можно будет разобрать заново
+            await archive_page(self.program, content)
+
+            # Разбор страницы выполняется вне event loop и без занятого слота хоста
+            snapshot = await asyncio.to_thread(self._parse_changed, content)
+
+            self.etag = etag
+            self.last_modified = last_modified
+            self.body_hash = body_hash
+            if snapshot is None:
+                return self._unchanged()
+            self.last_snapshot = snapshot
+            FETCH_TOTAL.inc(program=self.program, result='changed')
+            record_scrape(self.program)
+            return snapshot
+
+        except CircuitOpenError:
+            # Сайт недоступен: запрос даже не отправлялся
+            FETCH_TOTAL.inc(program=self.program, result='breaker_open')
+            return None
 
         except Exception as e:
+            FETCH_TOTAL.inc(program=self.program, result='error')
             moscow_time = self.format_moscow_time()
-            print(f"Ошибка парсинга в {moscow_time}: {e}")
-            return None
\ No newline at end of file
+            print(f"Ошибка парсинга {self.program or self.url} в {moscow_time}: {e}")
+            return None
+
+    async def _request(self):
+        """Один условный запрос: (тело, ETag, Last-Modified) или None, если ответ 304"""
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        async with get_host_limiter(self.url):
+            with FETCH_SECONDS.time(program=self.program):
+                async with get_session().get(self.url, headers=headers) as response:
+                    if response.status == 304 and self.last_snapshot is not None:
+                        return None
+
+                    response.raise_for_status()
+                    content = await response.read()
+                    return content, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    async def _request_with_retries(self):
+        """Запрос с повторами и экспоненциальной паузой через предохранитель хоста.
+
+        Все попытки вместе с паузами укладываются в FETCH_TIMEOUT: пользователь без
+        снимка в кэше ждет не дольше одного запроса, пока предохранитель набирает ошибки.
+        """
+        breaker = get_breaker(self.url)
+        deadline = time.monotonic() + FETCH_TIMEOUT
+        for attempt in range(FETCH_RETRIES + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f"{breaker.name} недоступен, повтор через {breaker.retry_in():.0f} с")
+            try:
+                response = await asyncio.wait_for(self._request(), max(deadline - time.monotonic(), 0.1))
+            except Exception as e:
+                breaker.record_failure()
+                delay = FETCH_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                if attempt == FETCH_RETRIES or not is_retryable(e) or time.monotonic() + delay >= deadline:
+                    raise
+                FETCH_TOTAL.inc(program=self.program, result='retry')
+                print(f"⚠️ {self.program or self.url}: {e!r}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return response
+
+    def _unchanged(self):
+        """Предыдущий снимок с текущим временем: рейтинг не изменился"""
+        FETCH_TOTAL.inc(program=self.program, result='not_modified')
+        record_scrape(self.program)
+        return dataclasses.replace(self.last_snapshot, timestamp=self.format_moscow_time(), not_modified=True)
+
+    def _parse_changed(self, content):
+        """Разобрать страницу; None, если строки рейтинга совпадают с последним снимком"""
+        with PARSE_SECONDS.time(program=self.program):
+            items = self.extract(content)
+            fingerprint = fingerprint_rows(items)
+            if self.last_snapshot is not None and fingerprint == self.last_snapshot.fingerprint:
+                return None
+            return RatingSnapshot.from_items(items, self.format_moscow_time(), self.program, fingerprint)
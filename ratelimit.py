@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду с запасом capacity на всплеск"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, tokens=1, now=None):
+        """Сколько секунд ждать, пока станет доступно tokens токенов"""
+        now = time.monotonic() if now is None else now
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def try_acquire(self, tokens=1, now=None):
+        """Взять токены без ожидания; False, если их недостаточно"""
+        now = time.monotonic() if now is None else now
+        if self.wait_time(tokens, now) > 0:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens=1):
+        """Дождаться и взять токены"""
+        while True:
+            delay = self.wait_time(tokens)
+            if delay <= 0:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Остановить выдачу токенов на seconds секунд (например, после RetryAfter)"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
@@ -0,0 +1,121 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import pytz
+
+from config import (SCHEDULE_MIN_INTERVAL, SCHEDULE_MAX_INTERVAL, PEAK_MIN_INTERVAL, PEAK_MAX_INTERVAL,
+                    SCHEDULE_JITTER, PEAK_WINDOWS)
+
+# Московская временная зона
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Во сколько раз растет интервал после каждой проверки без изменений
+BACKOFF_FACTOR = 2
+
+
+class AdaptiveScheduler:
+    """Периодический запуск задачи в основном event loop с адаптивным интервалом.
+
+    После изменений задача запускается через минимальный интервал, пока страница
+    не меняется - интервал удваивается до максимального. В пиковые окна (например,
+    перед окончанием приема документов) действуют свои, более короткие интервалы.
+    К интервалу добавляется случайный разброс, чтобы запросы не шли строго по сетке.
+    Задача - корутина без аргументов, возвращающая True, если данные изменились.
+    """
+
+    def __init__(self, job, min_interval=SCHEDULE_MIN_INTERVAL, max_interval=SCHEDULE_MAX_INTERVAL,
+                 peak_min_interval=PEAK_MIN_INTERVAL, peak_max_interval=PEAK_MAX_INTERVAL,
+                 jitter=SCHEDULE_JITTER, peak_windows=PEAK_WINDOWS):
+        self.job = job
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.peak_min_interval = peak_min_interval
+        self.peak_max_interval = peak_max_interval
+        self.jitter = jitter
+        self.peak_windows = [(MOSCOW_TZ.localize(start), MOSCOW_TZ.localize(end)) for start, end in peak_windows]
+
+        # Число запусков подряд без изменений
+        self.unchanged = 0
+        self.last_run = None
+        self.next_run = None
+        self.interval = None
+
+    def peak_window(self, moment):
+        """Пиковое окно, в которое попадает момент, или None"""
+        for start, end in self.peak_windows:
+            if start <= moment < end:
+                return start, end
+        return None
+
+    def _next_peak_start(self, moment):
+        starts = [start for start, _ in self.peak_windows if start > moment]
+        return min(starts) if starts else None
+
+    def schedule_next(self, changed):
+        """Рассчитать время следующего запуска по результату предыдущего"""
+        now = datetime.now(MOSCOW_TZ)
+        self.unchanged = 0 if changed else self.unchanged + 1
+
+        if self.peak_window(now):
+            low, high = self.peak_min_interval, self.peak_max_interval
+        else:
+            low, high = self.min_interval, self.max_interval
+
+        interval = min(low * BACKOFF_FACTOR ** self.unchanged, high)
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        next_run = now + timedelta(seconds=interval)
+
+        # Пиковое окно, начавшееся раньше следующего запуска, не пропускаем
+        peak_start = self._next_peak_start(now)
+        if peak_start and peak_start < next_run:
+            next_run = peak_start
+
+        self.interval = (next_run - now).total_seconds()
+        self.next_run = next_run
+        return next_run
+
+    async def run(self):
+        """Запускать задачу по расписанию, пока задача планировщика не отменена"""
+        if self.next_run is None:
+            self.schedule_next(changed=True)
+
+        while True:
+            delay = (self.next_run - datetime.now(MOSCOW_TZ)).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.last_run = datetime.now(MOSCOW_TZ)
+            try:
+                changed = await self.job()
+            except Exception as e:
+                print(f"❌ Ошибка в планировщике в {self.last_run.strftime('%Y-%m-%d %H:%M:%S')}: {e}")
+                changed = False
+
+            next_run = self.schedule_next(changed)
+            print(f"📅 Следующий парсинг в {next_run.strftime('%Y-%m-%d %H:%M:%S')} "
+                  f"(через {self.interval / 60:.0f} мин)")
+
+    def describe(self):
+        """Состояние планировщика для админа"""
+        def fmt(moment):
+            return moment.strftime('%Y-%m-%d %H:%M:%S') if moment else '—'
+
+        now = datetime.now(MOSCOW_TZ)
+        window = self.peak_window(now)
+        peak_start = self._next_peak_start(now)
+        if window:
+            peak = f"🔥 Пиковое окно до {fmt(window[1])}"
+        elif peak_start:
+            peak = f"Следующее пиковое окно: {fmt(peak_start)}"
+        else:
+            peak = "Пиковых окон нет"
+
+        interval = f"{self.interval / 60:.0f} мин" if self.interval is not None else '—'
+        return (
+            f"Последний запуск: {fmt(self.last_run)}\n"
+            f"Следующий запуск: {fmt(self.next_run)}\n"
+            f"Интервал: {interval}\n"
+            f"Запусков без изменений подряд: {self.unchanged}\n"
+            f"{peak}"
+        )
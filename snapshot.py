@@ -0,0 +1,156 @@
+import hashlib
+from collections import namedtuple
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+# Позиции абитуриента: в общем списке, среди договоров, среди оплаченных и неоплаченных
+Position = namedtuple('Position', ['overall', 'contract', 'paid', 'unpaid'])
+
+# Позиции пользователя, заранее посчитанные при сохранении снимка (таблица user_positions):
+# position и previous - Position или None, если абитуриента нет в списке;
+# previous_known - известна ли позиция того же ID в предыдущем сохраненном снимке
+UserPosition = namedtuple('UserPosition', ['your_id', 'fingerprint', 'position', 'previous', 'previous_known'])
+
+
+def fingerprint_rows(items):
+    """Отпечаток строк рейтинга: не зависит от разметки, только от номеров заявлений и договоров"""
+    digest = hashlib.blake2b(digest_size=16)
+    for application_id, has_contract, is_paid, is_unpaid in items:
+        digest.update(f"{application_id or ''}|{has_contract:d}{is_paid:d}{is_unpaid:d}\n".encode())
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class RatingSnapshot:
+    """Неизменяемый снимок рейтинга с индексом позиций по номеру заявления"""
+
+    timestamp: str
+    total_people: int
+    contract_count: int
+    contract_paid_count: int
+    contract_unpaid_count: int
+    # Строки рейтинга: (номер заявления, договор, оплачен, не оплачен)
+    items: tuple = field(repr=False)
+    positions: MappingProxyType = field(repr=False)
+    # Идентификатор программы, к которой относится снимок
+    program: str = None
+    # Страница не изменилась с прошлого запроса (ответ 304 или тот же отпечаток)
+    not_modified: bool = False
+    # Отпечаток строк рейтинга (fingerprint_rows)
+    fingerprint: str = None
+
+    @classmethod
+    def from_items(cls, items, timestamp, program=None, fingerprint=None):
+        """Построить снимок и индекс позиций за один проход по строкам"""
+        positions = {}
+        contract_count = 0
+        contract_paid_count = 0
+        contract_unpaid_count = 0
+
+        for overall, (application_id, has_contract, is_paid, is_unpaid) in enumerate(items, 1):
+            contract = paid = unpaid = None
+            if has_contract:
+                contract_count += 1
+                contract = contract_count
+                if is_paid:
+                    contract_paid_count += 1
+                    paid = contract_paid_count
+                elif is_unpaid:
+                    contract_unpaid_count += 1
+                    unpaid = contract_unpaid_count
+
+            # При повторе номера заявления учитывается первое вхождение
+            if application_id and application_id not in positions:
+                positions[application_id] = Position(overall, contract, paid, unpaid)
+
+        return cls(
+            timestamp=timestamp,
+            total_people=len(items),
+            contract_count=contract_count,
+            contract_paid_count=contract_paid_count,
+            contract_unpaid_count=contract_unpaid_count,
+            items=tuple(items),
+            positions=MappingProxyType(positions),
+            program=program,
+            fingerprint=fingerprint or fingerprint_rows(items)
+        )
+
+    def position_of(self, application_id):
+        """Позиции абитуриента за O(1) или None, если его нет в списке"""
+        if not application_id:
+            return None
+        return self.positions.get(application_id)
+
+    def user_position(self, application_id, precomputed=None):
+        """Позиция из UserPosition, если она посчитана для этого снимка и ID, иначе из индекса"""
+        if (precomputed is not None and precomputed.your_id == application_id
+                and precomputed.fingerprint == self.fingerprint):
+            return precomputed.position
+        return self.position_of(application_id)
+
+
+@dataclass(frozen=True)
+class SnapshotDiff:
+    """Изменения между двумя последовательными снимками одной программы"""
+
+    old: RatingSnapshot = field(repr=False)
+    new: RatingSnapshot = field(repr=False)
+    # Номера заявлений, появившихся в списке и пропавших из него
+    entered: tuple
+    left: tuple
+    # Номера заявлений, у которых появился или пропал договор
+    gained_contract: tuple
+    lost_contract: tuple
+    # Номера заявлений, у которых договор стал оплаченным
+    became_paid: tuple
+
+    @property
+    def contracts_changed(self):
+        """Изменилось что-то, о чем стоит уведомить подписчиков"""
+        return bool(
+            self.gained_contract or self.lost_contract or self.became_paid
+            or self.old.contract_count != self.new.contract_count
+            or self.old.contract_paid_count != self.new.contract_paid_count
+            or self.old.contract_unpaid_count != self.new.contract_unpaid_count
+        )
+
+
+def diff_snapshots(old, new):
+    """Построчное сравнение снимков за линейное время по индексам позиций"""
+    old_positions = old.positions
+    new_positions = new.positions
+
+    entered = []
+    gained_contract = []
+    lost_contract = []
+    became_paid = []
+
+    for application_id, position in new_positions.items():
+        previous = old_positions.get(application_id)
+        if previous is None:
+            entered.append(application_id)
+            if position.contract:
+                gained_contract.append(application_id)
+            if position.paid:
+                became_paid.append(application_id)
+            continue
+
+        if position.contract and not previous.contract:
+            gained_contract.append(application_id)
+        elif previous.contract and not position.contract:
+            lost_contract.append(application_id)
+        if position.paid and not previous.paid:
+            became_paid.append(application_id)
+
+    left = [application_id for application_id in old_positions if application_id not in new_positions]
+    lost_contract.extend(application_id for application_id in left if old_positions[application_id].contract)
+
+    return SnapshotDiff(
+        old=old,
+        new=new,
+        entered=tuple(entered),
+        left=tuple(left),
+        gained_contract=tuple(gained_contract),
+        lost_contract=tuple(lost_contract),
+        became_paid=tuple(became_paid)
+    )
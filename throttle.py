@@ -0,0 +1,117 @@
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+from config import (ADMIN_ID, THROTTLE_USER_RATE, THROTTLE_USER_BURST, THROTTLE_GLOBAL_RATE,
+                    THROTTLE_GLOBAL_BURST, THROTTLE_MAX_USERS)
+from metrics import THROTTLED_TOTAL
+from ratelimit import TokenBucket
+
+
+class _UserState:
+    """Ведро токенов пользователя, число отклоненных запросов и последний ответ для повтора"""
+
+    __slots__ = ('bucket', 'hits', 'warned', 'answer')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.hits = 0
+        self.warned = False
+        # (текст запроса, текст ответа, parse_mode)
+        self.answer = None
+
+
+class Throttle:
+    """Middleware aiogram: ограничение частоты запросов на пользователя и на весь бот.
+
+    Состояние пользователей хранится в LRU из max_users записей, поэтому память
+    не растет с числом пользователей (вытесненный пользователь получает полное ведро).
+    Отклоненный запрос не доходит до обработчиков и базы: если на такой же запрос
+    уже был ответ, пользователь получает его из памяти, иначе - предупреждение
+    (один раз за серию отклоненных запросов). Отклоненный callback всегда получает
+    ответ, чтобы кнопка перестала крутиться.
+    Админ не ограничивается.
+    """
+
+    def __init__(self, user_rate=THROTTLE_USER_RATE, user_burst=THROTTLE_USER_BURST,
+                 global_rate=THROTTLE_GLOBAL_RATE, global_burst=THROTTLE_GLOBAL_BURST, max_users=THROTTLE_MAX_USERS):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.users = OrderedDict()
+        self.hits = {'user': 0, 'global': 0}
+        self.served_cached = 0
+        self.evicted = 0
+
+    def _state(self, user_id):
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = _UserState(TokenBucket(self.user_rate, self.user_burst))
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.users.move_to_end(user_id)
+        return state
+
+    def check(self, user_id):
+        """Взять токен для запроса: None, если запрос разрешен, иначе 'user' или 'global'"""
+        state = self._state(user_id)
+        if not state.bucket.try_acquire():
+            scope = 'user'
+        elif not self.global_bucket.try_acquire():
+            # Токен пользователя возвращается: запрос отклонен не по его вине
+            state.bucket.tokens += 1
+            scope = 'global'
+        else:
+            state.warned = False
+            return None
+
+        state.hits += 1
+        self.hits[scope] += 1
+        THROTTLED_TOTAL.inc(scope=scope)
+        return scope
+
+    def remember(self, user_id, request, answer, parse_mode=None):
+        """Запомнить ответ на запрос: при ограничении он будет отправлен повторно"""
+        self._state(user_id).answer = (request, answer, parse_mode)
+
+    def top(self, limit=5):
+        """Пользователи с наибольшим числом отклоненных запросов: [(user_id, отклонено)]"""
+        hits = ((user_id, state.hits) for user_id, state in self.users.items() if state.hits)
+        return sorted(hits, key=lambda item: item[1], reverse=True)[:limit]
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+
+        scope = self.check(user.id)
+        if scope is None:
+            return await handler(event, data)
+
+        state = self.users[user.id]
+        warned, state.warned = state.warned, True
+        if isinstance(event, types.CallbackQuery):
+            # На каждый callback нужен ответ, иначе кнопка крутится до таймаута;
+            # текст показывается один раз за серию отклоненных запросов
+            try:
+                await event.answer(None if warned else "⏳ Слишком много запросов, попробуйте позже")
+            except TelegramBadRequest:
+                # Запрос уже устарел: отвечать на него поздно
+                pass
+            return None
+
+        # Отвечаем один раз за серию отклоненных запросов, остальные молча отбрасываются
+        if warned:
+            return None
+        if state.answer and event.text == state.answer[0]:
+            self.served_cached += 1
+            _, answer, parse_mode = state.answer
+            await event.answer(f"{answer}\n\n⏳ Слишком частые запросы: показан последний ответ",
+                               parse_mode=parse_mode)
+        else:
+            await event.answer("⏳ Слишком много запросов. Подождите немного и попробуйте снова.")
+        return None
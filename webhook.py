@@ -0,0 +1,69 @@
+"""Получение обновлений через webhook вместо long polling.
+
+Сервер aiohttp принимает POST от Telegram, проверяет заголовок
+X-Telegram-Bot-Api-Secret-Token и обрабатывает обновление в самом запросе, не
+больше MAX_INFLIGHT_UPDATES одновременно. Когда все слоты заняты, ответ
+задерживается, и Telegram сам притормаживает отправку. Обработчик дольше 55 с
+aiogram переводит в фон и отвечает сразу.
+"""
+import asyncio
+from json import JSONDecodeError
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from pydantic import ValidationError
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, MAX_INFLIGHT_UPDATES
+
+# Больше 100 одновременных соединений Telegram не открывает
+TELEGRAM_MAX_CONNECTIONS = 100
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook с ограничением числа одновременно обрабатываемых обновлений.
+
+    Использует только публичный handle() aiogram: слот занят, пока обновление
+    обрабатывается внутри запроса.
+    """
+
+    def __init__(self, dispatcher, bot, secret_token=WEBHOOK_SECRET, limit=MAX_INFLIGHT_UPDATES, **data):
+        super().__init__(dispatcher, bot, handle_in_background=False, secret_token=secret_token, **data)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def handle(self, request):
+        async with self._slots:
+            try:
+                return await super().handle(request)
+            except (JSONDecodeError, ValidationError):
+                # Тело запроса - не обновление Telegram
+                return web.Response(body="Bad Request", status=400)
+            except Exception as e:
+                # Как и при polling, ошибка обработчика не должна приводить к повторной доставке обновления
+                print(f"❌ Ошибка обработки обновления: {e}")
+                return web.json_response({})
+
+    __call__ = handle
+
+
+async def start_webhook(dispatcher, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH):
+    """Запустить сервер webhook и зарегистрировать его в Telegram, вернуть runner для остановки"""
+    app = web.Application()
+    BoundedRequestHandler(dispatcher, bot).register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"📡 Webhook слушает http://{host}:{port}{path}")
+
+    # Без публичного URL сервер принимает только локальные запросы (для проверки)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + path,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(MAX_INFLIGHT_UPDATES, TELEGRAM_MAX_CONNECTIONS)
+        )
+        print(f"✅ Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{path}")
+    else:
+        print("⚠️ WEBHOOK_URL не задан: webhook не зарегистрирован в Telegram")
+    return runner